@@ -8,7 +8,78 @@ DB_HOSTNAME = 'localhost',
 DATABASE = 'wiki'
 DB_USERNAME = 'wikiuser'
 DB_PASSWORD = 'wikipassword'
+# connection pool per WSGI process, keep DB_POOL_MAX at or above the number of threads
+# DB_POOL_MIN = 1
+# DB_POOL_MAX = 8
+# DB_POOL_IDLE_TIMEOUT = 300
+# DB_POOL_CHECK_INTERVAL = 30
+# seconds to wait for a new database connection
+# DB_CONNECT_TIMEOUT = 5
+
+# rendered articles kept in SESSION_REDIS (number of articles, seconds)
+# RENDER_CACHE_SIZE = 1000
+# RENDER_CACHE_TTL = 86400
+
+# edits per page on /activity
+# ACTIVITY_PAGE_SIZE = 100
+
+# seconds the user levels of the wiki account are kept in SESSION_REDIS
+# AUTHORITY_CACHE_TTL = 300
+
+# read articles from a Hive node if the updater didn't store them (yet)
+# CHAIN_FALLBACK = True
+
+# store the full text of every n-th revision of an article, used by the wiki and the updater
+# REVISION_SNAPSHOT_INTERVAL = 25
+
+# transactions kept in memory per process, all of them are stored in the database
+# TRANSACTION_CACHE_SIZE = 1024
+
+# seconds a compared pair of revisions is kept in SESSION_REDIS
+# COMPARE_CACHE_TTL = 604800
+
+# articles per sitemap, sitemap.xml becomes an index of sitemap-<n>.xml above
+# SITEMAP_SIZE = 50000
+
+# seconds the redirects of /revision/<trx_id> may be cached by browsers and proxies
+# IMMUTABLE_MAX_AGE = 31536000
+
+# results per search page, seconds a page of results is kept in SESSION_REDIS
+# SEARCH_PAGE_SIZE = 20
+# SEARCH_CACHE_TTL = 3600
+
+# seconds between checks for new articles in the title index of /api/suggest,
+# similar titles (pg_trgm) are looked up when no title starts with the query
+# SUGGEST_REFRESH_INTERVAL = 10
+# SUGGEST_FUZZY = True
+
+# seconds the replies of a talk page are fresh in SESSION_REDIS, stale ones are
+# shown for up to TALK_CACHE_STALE_TTL while they are fetched again
+# TALK_CACHE_TTL = 60
+# TALK_CACHE_STALE_TTL = 86400
 
 DISCORD_WEBHOOK = 'https://discord.com/api/webhooks/1234567890/abcdefg'
 WAVES_ACCOUNT = ''
-LEOTHREADS_ACCOUNT = ''
\ No newline at end of file
+LEOTHREADS_ACCOUNT = ''
+
+# notifier: seconds between two replies on Hive, retries of a failed announcement
+# NOTIFY_INTERVAL = 5
+# NOTIFY_POLL_INTERVAL = 5
+# NOTIFY_MAX_ATTEMPTS = 8
+# announce several queued edits of an article together, in the newest one
+# NOTIFY_COALESCE = True
+
+# updater: follow 'irreversible' or 'head' blocks, read up to UPDATER_BLOCK_RANGE blocks per transaction
+# UPDATER_MODE = 'irreversible'
+# UPDATER_BLOCK_RANGE = 100
+# UPDATER_MAX_BATCH_SIZE = 50
+# edits written and committed together
+# UPDATER_BATCH_SIZE = 100
+# seconds the account of a signing key is remembered, posting key changes are picked up right away
+# UPDATER_KEY_CACHE_TTL = 86400
+# threads fetching transactions and posts, processes recovering signatures (default: number of CPUs)
+# UPDATER_FETCH_WORKERS = 8
+# UPDATER_VERIFY_WORKERS = 4
+# python3 updater.py reindex: blocks per checkpoint, parallel account history requests
+# UPDATER_REINDEX_RANGE = 100000
+# UPDATER_REINDEX_WORKERS = 4
\ No newline at end of file
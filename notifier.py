@@ -0,0 +1,149 @@
+from beem import Hive
+from beem.account import Account
+from beem.comment import Comment
+
+import time
+import requests
+
+from configparser import ConfigParser
+from itertools import chain
+
+import psycopg2
+
+parser = ConfigParser()
+with open("./instance/config.py") as lines:
+    lines = chain(("[top]",), lines)
+    parser.read_file(lines)
+conf = parser['top']
+for i, v in conf.items():
+    # strip quotes of string values, numbers are kept as they are
+    if v[:1] in ['"',"'"]:
+        conf[i] = v[1:-1]
+
+conn = psycopg2.connect(
+    host=conf['DB_HOSTNAME'],
+    database=conf['DATABASE'],
+    user=conf['DB_USERNAME'],
+    password=conf['DB_PASSWORD'])
+
+client = Hive(keys=[conf['POSTING_KEY']], node="https://api.deathwing.me/")
+
+# seconds between two broadcasts to Hive
+interval = float(conf.get('NOTIFY_INTERVAL','5'))
+# seconds to sleep when the queue is empty
+poll_interval = float(conf.get('NOTIFY_POLL_INTERVAL','5'))
+max_attempts = int(conf.get('NOTIFY_MAX_ATTEMPTS','8'))
+# announce several queued edits of an article in one, per target
+coalesce = conf.get('NOTIFY_COALESCE','True') not in ['False','0','']
+
+class RetryLater(Exception):
+    def __init__(self, delay=None):
+        super().__init__(delay)
+        self.delay = delay
+
+def webhook_send(text):
+    url = conf['DISCORD_WEBHOOK']
+    data = {}
+    data["content"] = text
+    data["username"] = conf['WIKI_USER']+" activity"
+    r = requests.post(url, json=data, headers={"Content-Type": "application/json"}, timeout=30)
+    if r.status_code == 429:
+        try:
+            raise RetryLater(float(r.json()['retry_after']))
+        except (ValueError, KeyError):
+            raise RetryLater()
+    r.raise_for_status()
+    return r
+
+def send_to_waves(account,text,title):
+    wa = Account(account, blockchain_instance=client)
+    for post in wa.blog_history(limit=1,reblogs=False):
+        c = Comment(account+'/'+post['permlink'], blockchain_instance=client)
+        c.reply(text, title=title+' edited', author=conf['WIKI_USER'], meta=None)
+
+def send(target,text,title):
+    if target == 'discord':
+        webhook_send(text)
+    elif target.startswith('waves:'):
+        send_to_waves(target[len('waves:'):],text,title)
+    else:
+        raise ValueError('Unknown notification target '+target)
+
+def edit_line(target,editor,reason,link,text):
+    # one line about an edit merged into a newer announcement
+    if editor is None or link is None:
+        # queued without the details of the edit
+        return ' '.join(text.split())
+    line = ('@' if target.startswith('waves:') else '')+editor
+    if reason is not None:
+        line += ' ('+reason+')'
+    return line+' '+link
+
+def coalesce_pending(cur):
+    # older pending announcements of an article are merged into the newest one,
+    # which lists their editors, reasons and revision links in earlier
+    cur.execute("SELECT id, target, permlink, editor, reason, link, text, earlier FROM notifications"
+        " WHERE status='pending' AND permlink IS NOT NULL ORDER BY id ASC FOR UPDATE SKIP LOCKED")
+    queued = {}
+    for row in cur.fetchall():
+        queued.setdefault((row[1],row[2]),[]).append(row)
+    coalesced = 0
+    for rows in queued.values():
+        if len(rows) < 2:
+            continue
+        lines = []
+        for notification_id, target, permlink, editor, reason, link, text, earlier in rows[:-1]:
+            if earlier is not None:
+                lines.append(earlier)
+            lines.append(edit_line(target,editor,reason,link,text))
+        if rows[-1][7] is not None:
+            lines.append(rows[-1][7])
+        cur.execute("UPDATE notifications SET earlier=%s WHERE id=%s",("\n".join(lines),rows[-1][0]))
+        cur.execute("UPDATE notifications SET status='coalesced' WHERE id = ANY(%s)",([row[0] for row in rows[:-1]],))
+        coalesced += len(rows) - 1
+    return coalesced
+
+def next_notification(cur):
+    cur.execute("SELECT id, target, text, title, attempts, earlier FROM notifications"
+        " WHERE status='pending' AND next_attempt <= now() ORDER BY id ASC LIMIT 1 FOR UPDATE SKIP LOCKED")
+    return cur.fetchone()
+
+def retry_delay(attempts):
+    return min(30 * 2 ** attempts, 3600)
+
+cur = conn.cursor()
+last_broadcast = 0
+while 1 == 1:
+    if coalesce:
+        coalesce_pending(cur)
+        conn.commit()
+    row = next_notification(cur)
+    if row is None:
+        conn.commit()
+        time.sleep(poll_interval)
+        continue
+    notification_id, target, text, title, attempts, earlier = row
+    if earlier is not None:
+        text += "\nEarlier edits:\n"+earlier
+    if target != 'discord':
+        wait = interval - (time.monotonic() - last_broadcast)
+        if wait > 0:
+            time.sleep(wait)
+    try:
+        send(target,text,title)
+        cur.execute("UPDATE notifications SET status='sent', sent=now(), attempts=attempts+1 WHERE id=%s",(notification_id,))
+    except RetryLater as e:
+        delay = e.delay if e.delay is not None else retry_delay(attempts)
+        print('Rate limited on '+target+', retrying in '+str(delay)+'s')
+        cur.execute("UPDATE notifications SET next_attempt=now() + %s * interval '1 second' WHERE id=%s",(delay,notification_id))
+    except Exception as e:
+        attempts += 1
+        print('Sending notification '+str(notification_id)+' failed: '+str(e))
+        if attempts >= max_attempts:
+            cur.execute("UPDATE notifications SET status='failed', attempts=%s WHERE id=%s",(attempts,notification_id))
+        else:
+            cur.execute("UPDATE notifications SET attempts=%s, next_attempt=now() + %s * interval '1 second' WHERE id=%s",
+                (attempts,retry_delay(attempts),notification_id))
+    if target != 'discord':
+        last_broadcast = time.monotonic()
+    conn.commit()
@@ -0,0 +1,117 @@
+from beem import Hive
+from beem.blockchain import Blockchain
+from beem.comment import Comment
+from beem.transactionbuilder import TransactionBuilder
+from beembase import operations
+from beemgraphenebase.account import PrivateKey
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wiki.signatures import recoverPublicKeys
+
+# Throughput of the ingest stages of updater.py (get_transaction, the post
+# and signature recovery per edit) against a local stand-in node that
+# answers with a fixed latency, serially and with the updater's pools.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--edits', type=int, default=100)
+parser.add_argument('--latency', type=float, default=0.05, help='seconds per node request')
+parser.add_argument('--fetch-workers', type=int, default=8)
+parser.add_argument('--verify-workers', type=int, default=os.cpu_count() or 1)
+args = parser.parse_args()
+
+def sign_edits(count):
+    key = PrivateKey()
+    offline = Hive(offline=True, keys=[str(key)])
+    transactions = {}
+    posts = {}
+    for i in range(count):
+        permlink = 'article-'+str(i)
+        op = {'parent_author': '', 'parent_permlink': 'wiki', 'author': 'propolis.wiki', 'permlink': permlink,
+            'title': 'Article '+str(i), 'body': 'Text of article '+str(i), 'json_metadata': '{"tags":["test"]}'}
+        tx = TransactionBuilder(blockchain_instance=offline, expiration=3600)
+        tx.appendOps(operations.Comment(**op))
+        tx.appendWif(str(key))
+        tx.constructTx(ref_block_num=i % 65536, ref_block_prefix=i)
+        trx_id = '%040x' % i
+        transactions[trx_id] = json.loads(json.dumps(tx.sign(reconstruct_tx=False).json()))
+        posts[permlink] = dict(op, created='2024-01-01T00:00:00', last_update='2024-01-01T00:00:00')
+    return transactions, posts
+
+transactions, posts = sign_edits(args.edits)
+
+class StandInNode(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(args.latency)
+        if request['method'] == 'account_history_api.get_transaction':
+            result = transactions[request['params']['id']]
+        elif request['method'] == 'bridge.get_post':
+            result = posts[request['params']['permlink']]
+        else:
+            result = {}
+        body = json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StandInNode)
+node = 'http://127.0.0.1:'+str(server.server_port)
+
+worker = threading.local()
+
+def fetch_edit(trx_id, permlink):
+    if not hasattr(worker, 'client'):
+        worker.client = Hive(node=node)
+        worker.blockchain = Blockchain(blockchain_instance=worker.client)
+    transaction = worker.blockchain.get_transaction(trx_id)
+    post = Comment('propolis.wiki/'+permlink, blockchain_instance=worker.client)
+    return transaction, post
+
+edits = [(trx_id, transaction['operations'][0][1]['permlink']) for trx_id, transaction in transactions.items()]
+
+def serial():
+    for trx_id, permlink in edits:
+        transaction, post = fetch_edit(trx_id, permlink)
+        recoverPublicKeys(transaction)
+
+def pipelined():
+    fetches = [fetch_pool.submit(fetch_edit, trx_id, permlink) for trx_id, permlink in edits]
+    verified = []
+    for fetch in fetches:
+        transaction, post = fetch.result()
+        verified.append(verify_pool.submit(recoverPublicKeys, transaction))
+    for keys in verified:
+        keys.result()
+
+# forked before any thread is started, like in updater.py
+verify_pool = ProcessPoolExecutor(args.verify_workers, mp_context=multiprocessing.get_context('fork'))
+verify_pool.submit(int).result()
+fetch_pool = ThreadPoolExecutor(args.fetch_workers)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+print(str(args.edits)+' edits, '+str(args.latency*1000)+'ms per request, '
+    +str(args.fetch_workers)+' fetch workers, '+str(args.verify_workers)+' verify workers')
+for name, run in [('serial', serial), ('pipelined', pipelined)]:
+    start = time.monotonic()
+    run()
+    elapsed = time.monotonic() - start
+    print(name+': '+str(round(args.edits/elapsed, 1))+' ops/s ('+str(round(elapsed, 2))+'s)')
+
+fetch_pool.shutdown()
+verify_pool.shutdown()
+server.shutdown()
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wiki import create_app
+from wiki.wiki import IrregularMarkup, db_get_all, renderBody, wikifyBodyStages
+
+# Renders the stored articles with wikifyBodyStages() and renderBody(),
+# checks both give the same html and compares their speed. Uses the
+# database of instance/config.py.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--limit', type=int, default=None, help='number of articles, all by default')
+parser.add_argument('--rounds', type=int, default=3)
+args = parser.parse_args()
+
+app = create_app()
+with app.test_request_context():
+    query = 'SELECT permlink, body FROM posts WHERE body IS NOT NULL ORDER BY permlink'
+    if args.limit is not None:
+        query += ' LIMIT %d' % args.limit
+    articles = db_get_all(query)
+
+    fast = []
+    irregular = 0
+    different = 0
+    for permlink, body in articles:
+        try:
+            html = renderBody(body)
+        except IrregularMarkup as e:
+            print(permlink+': '+str(e)+', rendered in stages')
+            irregular += 1
+            continue
+        if html != wikifyBodyStages(body):
+            print(permlink+': different html')
+            different += 1
+        fast.append(body)
+
+    print(str(len(articles))+' articles, '+str(sum(len(body) for permlink, body in articles))+' characters, '
+        +str(irregular)+' rendered in stages, '+str(different)+' different')
+    times = {}
+    for i in range(args.rounds):
+        for name, render in [('stages', wikifyBodyStages), ('single pass', renderBody)]:
+            start = time.perf_counter()
+            for body in fast:
+                render(body)
+            times[name] = min(times.get(name, float('inf')), time.perf_counter() - start)
+    for name, elapsed in times.items():
+        print(name+': '+str(round(elapsed*1000, 1))+'ms')
+    if times['single pass'] > 0:
+        print('speedup: '+str(round(times['stages']/times['single pass'], 2))+'x')
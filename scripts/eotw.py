@@ -1,11 +1,16 @@
 from beem.blockchain import Blockchain
 
+import os
+import sys
 import datetime
 from configparser import ConfigParser
 from itertools import chain
 
 import psycopg2
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from wiki.transactions import TransactionCache
+
 parser = ConfigParser()
 with open("../instance/config.py") as lines:
     lines = chain(("[top]",), lines)
@@ -21,6 +26,7 @@ conn = psycopg2.connect(
     password=conf['DB_PASSWORD'])
 
 hive = Blockchain()
+transactions = TransactionCache()
 
 cur = conn.cursor()
 
@@ -30,12 +36,15 @@ today = datetime.date.today()
 tots = today - datetime.timedelta(days=1)
 fromts = today - datetime.timedelta(days=8)
 print('from '+fromts.strftime('%Y-%m-%d %H:%M')+' to '+tots.strftime('%Y-%m-%d %H:%M'))
-cur.execute('SELECT trx_id, timestamp, permlink, author FROM comments WHERE timestamp >= %s AND timestamp <= %s ORDER BY timestamp ASC;',(fromts,tots,))
+cur.execute('SELECT trx_id, timestamp, permlink, author, body FROM comments WHERE timestamp >= %s AND timestamp <= %s ORDER BY timestamp ASC;',(fromts,tots,))
 edits = cur.fetchall()
 collection = {}
 for edit in edits:
-    post = hive.get_transaction(edit[0])
-    body = post['operations'][0]['value']['body']
+    body = edit[4]
+    if body is None:
+        # edits from before the updater stored bodies
+        post = transactions.get(cur,edit[0],hive.get_transaction)
+        body = post['operations'][0]['value']['body']
     if edit[2] in collection:
         if edit[3] in collection[edit[2]]:
             collection[edit[2]][edit[3]]['count'] += 1
@@ -58,6 +67,8 @@ for edit in edits:
                 'timestamp':edit[1].strftime('%Y-%m-%d %H:%M')
             }
         }
+# keep the transactions fetched for the cache
+conn.commit()
 sorted = []
 for article, c in collection.items():
     add = {}
@@ -4,19 +4,30 @@ from beem.blockchain import Blockchain
 from beem.comment import Comment
 from beem.transactionbuilder import TransactionBuilder
 from beem.wallet import Wallet
+from beem.utils import formatTimeString
 from beembase import operations
-from beembase.signedtransactions import Signed_Transaction
-from beemgraphenebase.base58 import Base58
 
 from pprint import pprint
+import os
+import sys
 import time
 import json
-import requests
+import threading
+import multiprocessing
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from configparser import ConfigParser
 from itertools import chain
 
 import psycopg2
+import redis
+from psycopg2.extras import execute_values
+
+from wiki.cache import AuthorityCache, RenderCache, SearchCache
+from wiki.links import linkedPermlinks
+from wiki.revisions import materializeRevision
+from wiki.signatures import recoverPublicKeys
+from wiki.transactions import TransactionCache
 
 parser = ConfigParser()
 with open("./instance/config.py") as lines:
@@ -24,7 +35,9 @@ with open("./instance/config.py") as lines:
     parser.read_file(lines)
 conf = parser['top']
 for i, v in conf.items():
-    conf[i] = v[1:-1]
+    # strip quotes of string values, numbers are kept as they are
+    if v[:1] in ['"',"'"]:
+        conf[i] = v[1:-1]
 
 conn = psycopg2.connect(
     host=conf['DB_HOSTNAME'],
@@ -32,6 +45,10 @@ conn = psycopg2.connect(
     user=conf['DB_USERNAME'],
     password=conf['DB_PASSWORD'])
 
+cache = redis.from_url(conf.get('SESSION_REDIS','redis://127.0.0.1:6379'))
+snapshot_interval = int(conf.get('REVISION_SNAPSHOT_INTERVAL','25'))
+transactions = TransactionCache(int(conf.get('TRANSACTION_CACHE_SIZE','1024')))
+
 def formatPostLink(permlink):
     split = permlink.split("-")
     if(len(split) > 1):
@@ -60,158 +77,641 @@ def formatPostLinkSegment(segment):
         return segment.lower()
     return segment
 
-def webhook_send(text):
-    url = conf['DISCORD_WEBHOOK']
-    data = {}
-    data["content"] = text
-    data["username"] = conf['WIKI_USER']+" activity"
-    return requests.post(url, json=data, headers={"Content-Type": "application/json"})
+def update_categories(cur,tags):
+    # rewrite the categories of posts ({permlink: tags}) and keep
+    # categories.post_count in step, categories left without posts are removed
+    cur.execute('DELETE FROM categories_posts WHERE permlink = ANY(%s) RETURNING category',
+        (list(tags.keys()),))
+    changed = set(c[0] for c in cur.fetchall())
+    rows = []
+    for permlink, post_tags in tags.items():
+        inserted = set()
+        for tag in post_tags:
+            if(tag != 'wiki' and tag != '' and tag not in inserted):
+                rows.append((permlink,tag))
+                inserted.add(tag)
+    inserted = set(row[1] for row in rows)
+    if len(rows) > 0:
+        execute_values(cur,'INSERT INTO categories (category) VALUES %s ON CONFLICT(category) DO NOTHING',
+            [(tag,) for tag in inserted])
+        execute_values(cur,'INSERT INTO categories_posts (permlink, category) VALUES %s',rows)
+    count_categories(cur,list(changed | inserted))
+
+def count_categories(cur,categories=None):
+    recount = 'UPDATE categories SET post_count = (SELECT count(*) FROM categories_posts WHERE categories_posts.category = categories.category)'
+    prune = 'DELETE FROM categories WHERE post_count = 0'
+    if categories is None:
+        cur.execute(recount)
+        cur.execute(prune)
+    else:
+        cur.execute(recount+' WHERE category = ANY(%s)',(categories,))
+        cur.execute(prune+' AND category = ANY(%s)',(categories,))
+
+def invalidate_render_cache(permlink):
+    RenderCache(cache).invalidate(permlink)
+
+def publish_ingest_cursor(position):
+    # cached search results of older positions aren't used anymore
+    try:
+        cache.set(SearchCache.cursor_key,':'.join(str(p) for p in position))
+    except redis.RedisError as error:
+        pprint(error)
+
+def invalidate_authorities():
+    try:
+        cache.delete(AuthorityCache.key)
+    except redis.RedisError as error:
+        pprint(error)
+
+def queue_notification(cur,target,text,permlink=None,trx_id=None,title=None,editor=None,reason=None,link=None):
+    # announcements are sent by notifier.py from the notifications table,
+    # they are queued in the transaction of the edit they announce. editor,
+    # reason and link describe the edit when it is merged into a newer one.
+    cur.execute('INSERT INTO notifications (target, text, permlink, trx_id, title, editor, reason, link) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+        (target,text,permlink,trx_id,title,editor,reason,link))
+
+def queue_announcements(cur,record):
+    op = record['op']
+    metadata = record['metadata']
+    rev_link = 'https://propol.is/history/'+formatPostLink(op['permlink'])+'/revision/'+op['trx_id']
+    editor = metadata['appdata']['user']
+    reason = metadata['appdata'].get('reason') or None
+    if conf.get('DISCORD_WEBHOOK','') != '':
+        webhook_text = 'New edit by '+str(metadata['appdata']['user'])+' on article '+op['title']
+        if 'reason' in metadata['appdata']:
+            webhook_text += ' ('+metadata['appdata']['reason']+')'
+        webhook_text += ' '+rev_link
+        queue_notification(cur,'discord',webhook_text,op['permlink'],op['trx_id'],op['title'],editor,reason,rev_link)
 
-def send_to_waves(title,metadata,link,permlink):
-    text = 'The Propolis wiki article '+title+' was edited by @'+metadata['appdata']['user']+"\n"
+    accounts = []
+    if conf.get('WAVES_ACCOUNT','') != '':
+        accounts.append(conf['WAVES_ACCOUNT'])
+    if conf.get('LEOTHREADS_ACCOUNT','') != '':
+        accounts.append(conf['LEOTHREADS_ACCOUNT'])
+    if len(accounts) == 0 or metadata['appdata']['user'] is None:
+        return
+    text = 'The Propolis wiki article '+op['title']+' was edited by @'+metadata['appdata']['user']+"\n"
     if('reason' in metadata['appdata'] and metadata['appdata']['reason'] != ''):
         text += 'Reason: '+metadata['appdata']['reason']+"\n"
-    text += link
-    cur.execute('SELECT author FROM comments WHERE permlink=%s ORDER BY timestamp ASC',(permlink,))
-    try: 
-        authors = cur.fetchall()
-    except:
-        authors = []
-    if len(authors) > 1:
+    text += rev_link
+    cur.execute('SELECT author FROM comments WHERE permlink=%s AND timestamp < %s ORDER BY timestamp ASC',(op['permlink'],record['timestamp']))
+    authors = cur.fetchall()
+    if len(authors) > 0:
         printed = []
         text += "\n"+'Previous editors:'
-        for i, author in enumerate(authors):
-            if author not in printed and i < len(authors)-1:
-                text += ' @'+author[0]
+        for author in authors:
+            if author not in printed:
+                text += ' @'+str(author[0])
                 printed.append(author)
-    accounts = []
-    if conf['WAVES_ACCOUNT'] != '':
-        accounts.append(conf['WAVES_ACCOUNT'])
-    if conf['LEOTHREADS_ACCOUNT'] != '':
-        accounts.append(conf['LEOTHREADS_ACCOUNT'])
-    for w in accounts:
-        wa = Account(w)
-        for post in wa.blog_history(limit=1,reblogs=False):
-            c = Comment(w+'/'+post['permlink'], hive_instance=client)
-            c.reply(text, title=title+' edited', author=conf['WIKI_USER'], meta=None)
-            time.sleep(5)
+    for account in accounts:
+        queue_notification(cur,'waves:'+account,text,op['permlink'],op['trx_id'],op['title'],editor,reason,rev_link)
+
+def number_revisions(cur):
+    # number edits per article, 1 is the first version
+    cur.execute('UPDATE comments SET revision = numbered.revision'
+        ' FROM (SELECT trx_id, row_number() OVER (PARTITION BY permlink ORDER BY timestamp) AS revision FROM comments) numbered'
+        ' WHERE comments.trx_id = numbered.trx_id AND comments.revision IS NULL')
+
+def index_links(cur,bodies):
+    # replace the rows in links of the articles in bodies, (permlink, body)
+    if len(bodies) == 0:
+        return
+    cur.execute('DELETE FROM links WHERE source = ANY(%s)',([permlink for permlink, body in bodies],))
+    execute_values(cur,'INSERT INTO links (source, target) VALUES %s ON CONFLICT DO NOTHING',
+        [(permlink, target) for permlink, body in bodies for target in linkedPermlinks(body,conf['WIKI_USER'])],page_size=1000)
+
+def relink_articles(cur,targets):
+    # new versions of the articles linking to targets, whose red or blue links
+    # changed. Returns their permlinks.
+    cur.execute('UPDATE posts SET links_version = links_version+1'
+        ' WHERE permlink IN (SELECT source FROM links WHERE target = ANY(%s)) RETURNING permlink',(targets,))
+    return [row[0] for row in cur.fetchall()]
+
+def setup_db():
+    # schema used by the updater and the wiki, safe to run on every start
+    cur = conn.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS posts (permlink varchar PRIMARY KEY, tsvector tsvector)')
+    cur.execute('ALTER TABLE posts ADD COLUMN IF NOT EXISTS title varchar,'
+        ' ADD COLUMN IF NOT EXISTS trx_id varchar,'
+        ' ADD COLUMN IF NOT EXISTS last_modified timestamp,'
+        ' ADD COLUMN IF NOT EXISTS last_author varchar,'
+        ' ADD COLUMN IF NOT EXISTS revisions integer NOT NULL DEFAULT 0,'
+        ' ADD COLUMN IF NOT EXISTS abstract text,'
+        ' ADD COLUMN IF NOT EXISTS body text,'
+        ' ADD COLUMN IF NOT EXISTS json_metadata text,'
+        ' ADD COLUMN IF NOT EXISTS links_version integer NOT NULL DEFAULT 0')
+    cur.execute('CREATE TABLE IF NOT EXISTS comments (trx_id varchar PRIMARY KEY, permlink varchar NOT NULL, timestamp timestamp NOT NULL, author varchar)')
+    cur.execute('ALTER TABLE comments ADD COLUMN IF NOT EXISTS title varchar,'
+        ' ADD COLUMN IF NOT EXISTS body text,'
+        ' ADD COLUMN IF NOT EXISTS json_metadata text,'
+        ' ADD COLUMN IF NOT EXISTS revision integer,'
+        ' ADD COLUMN IF NOT EXISTS snapshot bytea')
+    number_revisions(cur)
+    cur.execute('CREATE TABLE IF NOT EXISTS updater_state (name varchar PRIMARY KEY, block_num integer NOT NULL, trx_num integer, op_num integer)')
+    cur.execute('CREATE TABLE IF NOT EXISTS public_keys (public_key varchar PRIMARY KEY, account varchar, updated timestamptz NOT NULL)')
+    cur.execute('CREATE INDEX IF NOT EXISTS public_keys_account ON public_keys (account)')
+    cur.execute('CREATE TABLE IF NOT EXISTS notifications (id serial PRIMARY KEY, target varchar NOT NULL, text text NOT NULL, permlink varchar, trx_id varchar, title varchar,'
+        " status varchar NOT NULL DEFAULT 'pending', attempts integer NOT NULL DEFAULT 0, next_attempt timestamptz NOT NULL DEFAULT now(), created timestamptz NOT NULL DEFAULT now(), sent timestamptz)")
+    cur.execute('ALTER TABLE notifications ADD COLUMN IF NOT EXISTS editor varchar,'
+        ' ADD COLUMN IF NOT EXISTS reason text,'
+        ' ADD COLUMN IF NOT EXISTS link varchar,'
+        ' ADD COLUMN IF NOT EXISTS earlier text')
+    cur.execute("CREATE INDEX IF NOT EXISTS notifications_pending ON notifications (next_attempt) WHERE status = 'pending'")
+    cur.execute('CREATE TABLE IF NOT EXISTS transactions (trx_id varchar PRIMARY KEY, data jsonb NOT NULL)')
+    cur.execute('CREATE TABLE IF NOT EXISTS links (source varchar NOT NULL, target varchar NOT NULL, PRIMARY KEY (source, target))')
+    cur.execute('CREATE INDEX IF NOT EXISTS links_target ON links (target)')
+    cur.execute('CREATE TABLE IF NOT EXISTS categories (category varchar PRIMARY KEY)')
+    cur.execute('ALTER TABLE categories ADD COLUMN IF NOT EXISTS post_count integer NOT NULL DEFAULT 0')
+    cur.execute('CREATE TABLE IF NOT EXISTS categories_posts (permlink varchar NOT NULL, category varchar NOT NULL)')
+    cur.execute('CREATE INDEX IF NOT EXISTS posts_tsvector ON posts USING gin (tsvector)')
+    cur.execute('CREATE INDEX IF NOT EXISTS comments_permlink_timestamp ON comments (permlink, timestamp)')
+    cur.execute('CREATE INDEX IF NOT EXISTS comments_timestamp_trx_id ON comments (timestamp, trx_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS comments_author ON comments (author)')
+    cur.execute('CREATE INDEX IF NOT EXISTS categories_posts_category ON categories_posts (category)')
+    cur.execute('CREATE INDEX IF NOT EXISTS categories_posts_permlink ON categories_posts (permlink)')
+    # typo tolerant title suggestions, skipped if the extension can't be created
+    cur.execute('SAVEPOINT trigram')
+    try:
+        cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        cur.execute('CREATE INDEX IF NOT EXISTS posts_title_trgm ON posts USING gin (title gin_trgm_ops)')
+    except psycopg2.Error as error:
+        pprint(error)
+        cur.execute('ROLLBACK TO SAVEPOINT trigram')
+    count_categories(cur)
+    # fill the revision columns of posts ingested before they existed
+    cur.execute('UPDATE posts SET trx_id = latest.trx_id, last_modified = latest.timestamp, last_author = latest.author, revisions = latest.revisions'
+        ' FROM (SELECT DISTINCT ON (permlink) permlink, trx_id, timestamp, author, count(*) OVER (PARTITION BY permlink) AS revisions'
+        ' FROM comments ORDER BY permlink, timestamp DESC) latest'
+        ' WHERE posts.permlink = latest.permlink AND posts.trx_id IS NULL')
+    # links of articles stored before the table existed
+    cur.execute('SELECT EXISTS (SELECT 1 FROM links)')
+    if not cur.fetchone()[0]:
+        cur.execute('SELECT permlink, body FROM posts WHERE body IS NOT NULL')
+        index_links(cur,cur.fetchall())
+    conn.commit()
+    cur.close()
+
+setup_db()
 
 client = Hive(keys=[conf['ACTIVE_KEY'],conf['POSTING_KEY']], node="https://api.deathwing.me/")
 
-# start from block after wiki user account creation
-startblock = 1
-while startblock == 1:
+def backfill_posts():
+    # content of posts and revisions ingested before it was stored locally
+    cur = conn.cursor()
+    cur.execute('SELECT permlink FROM posts WHERE body IS NULL')
+    for permlink in cur.fetchall():
+        try:
+            post = Comment(conf['WIKI_USER']+"/"+permlink[0], blockchain_instance=client)
+        except Exception as error:
+            pprint(error)
+            continue
+        abstract = ''
+        split = post['body'].split("\n## ",1)
+        if(len(split) > 1):
+            abstract = split[0]
+        cur.execute('UPDATE posts SET title=%s, abstract=%s, body=%s, json_metadata=%s WHERE permlink=%s',
+            (post['title'],abstract,post['body'],json.dumps(post['json_metadata']),permlink[0]))
+        conn.commit()
+    hive = Blockchain(blockchain_instance=client)
+    cur.execute('SELECT trx_id FROM comments WHERE body IS NULL')
+    for trx_id in cur.fetchall():
+        try:
+            rev = transactions.get(cur,trx_id[0],hive.get_transaction)['operations'][0]['value']
+        except Exception as error:
+            pprint(error)
+            continue
+        cur.execute('UPDATE comments SET title=%s, body=%s, json_metadata=%s WHERE trx_id=%s',
+            (rev['title'],rev['body'],rev['json_metadata'],trx_id[0]))
+        conn.commit()
+    cur.close()
+
+backfill_posts()
+
+def key_account(cur,public_key):
+    # account of a public key, kept in public_keys for key_cache_ttl seconds
+    cur.execute('SELECT account FROM public_keys WHERE public_key=%s AND updated > now() - %s * interval \'1 second\'',
+        (public_key,key_cache_ttl))
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+    account = w.getAccountFromPublicKey(public_key)
+    cur.execute('INSERT INTO public_keys (public_key, account, updated) VALUES (%s, %s, now())'
+        ' ON CONFLICT(public_key) DO UPDATE SET account = EXCLUDED.account, updated = EXCLUDED.updated',
+        (public_key,account))
+    return account
+
+def invalidate_keys(cur,op):
+    # forget the keys of an account whose posting authority changed, and the
+    # keys it was given
+    if 'posting' not in op or op['posting'] is None:
+        return
+    keys = [auth[0] for auth in op['posting'].get('key_auths',[])]
+    cur.execute('DELETE FROM public_keys WHERE account=%s OR public_key = ANY(%s)',
+        (op['account'],keys))
+
+def is_edit(op):
+    # Only process comments authored by the wiki user in the category wiki
+    return op['type'] == 'comment' and op['author'] == conf['WIKI_USER'] and op['parent_permlink'] == 'wiki'
+
+def worker_client():
+    # fetch workers don't share the beem instance of the main thread
+    if not hasattr(worker, 'client'):
+        worker.client = Hive(node=client.rpc.url)
+        worker.blockchain = Blockchain(blockchain_instance=worker.client)
+    return worker.client
+
+def fetch_post(permlink,blockchain_instance):
+    post = {}
+    while post == {}:
+        try:
+            post = Comment(conf['WIKI_USER']+"/"+permlink, blockchain_instance=blockchain_instance)
+        except:
+            time.sleep(1)
+    return post
+
+def fetch_edit(op,transaction,fetch_posts):
+    # the node requests of an edit, run in the fetch pool
+    blockchain_instance = worker_client()
+    if transaction is None:
+        transaction = worker.blockchain.get_transaction(op['trx_id'])
+    if not fetch_posts:
+        return transaction, None
+    return transaction, fetch_post(op['permlink'],blockchain_instance)
+
+def submit_edits(cur,ops,fetch_posts=True):
+    # fetch the transactions and posts of edits in the fetch pool and recover
+    # their signing keys in the verify pool as the fetches come in.
+    # Returns (post, future of the public keys) in the order of ops, post is
+    # None unless fetch_posts.
+    known = transactions.lookup(cur,[op['trx_id'] for op in ops])
+    fetches = [fetch_pool.submit(fetch_edit,op,known.get(op['trx_id']),fetch_posts) for op in ops]
+    edits = []
+    for op, fetch in zip(ops,fetches):
+        transaction, post = fetch.result()
+        if op['trx_id'] not in known:
+            known[op['trx_id']] = transactions.store(cur,op['trx_id'],transaction)
+        edits.append((post,verify_pool.submit(recoverPublicKeys,transaction)))
+    return edits
+
+def edit_metadata(op):
+    metadata = json.loads(op['json_metadata'])
+    if 'appdata' not in metadata or 'user' not in metadata['appdata']:
+        metadata.setdefault('appdata',{})['user'] = None
+    return metadata
+
+def signing_account(cur,public_keys):
+    signer = ''
+    for key in public_keys:
+        owner = key_account(cur,key)
+        if(owner != None):
+            signer = owner
+    return signer
+
+def split_abstract(body):
+    # (abstract, rest of the text) of an article, the abstract is the text
+    # before the first heading
+    split = body.split("\n## ",1)
+    if(len(split) > 1):
+        return split[0], split[1]
+    return '', body
+
+def prepare_comment(cur,op,public_keys,post):
+    # check an edit of a wiki article and collect what write_batch() stores,
+    # the signing keys are resolved to accounts here, in chain order
+    pprint('Processing transaction '+op['trx_id'])
+
+    metadata = edit_metadata(op)
+    signer = signing_account(cur,public_keys)
     try:
-        acc = Account(conf['WIKI_USER'], blockchain_instance=client)
-        for op in acc.history(use_block_num=False,start=0,stop=1):
-            startblock = op['block']
+        if(signer == metadata['appdata']['user']):
+            s = True
+        else:
+            s = False
     except:
-        startblock = 1
+        s = False
+    if(s == False):
+        pprint("User in metadata isn't signer. Removing signer's access.")
+        if conf.get('DISCORD_WEBHOOK','') != '':
+            queue_notification(cur,'discord',"User in metadata didn't sign the transaction. Removing authorization for "+signer)
+        account = Account(conf['WIKI_USER'], blockchain_instance=client)
+        for i, auth in enumerate(account["posting"]["account_auths"]):
+            if(auth[0] == signer):
+                account['posting']['account_auths'].pop(i)
+                update_op = operations.Account_update(**{"account": conf['WIKI_USER'],
+                    "posting": account["posting"],
+                    "memo_key": account["memo_key"],
+                    "json_metadata": account["json_metadata"]})
+                tx = TransactionBuilder()
+                tx.appendOps(update_op)
+                tx.appendWif(conf['ACTIVE_KEY'])
+                tx.sign()
+                tx.broadcast()
+                invalidate_authorities()
+                break
+        metadata['appdata']['user'] = None
 
-while 1 == 1:
+    abstract, body = split_abstract(post['body'])
+    return {
+        'op': op,
+        'timestamp': op['timestamp'].replace(tzinfo=None),
+        'metadata': metadata,
+        'tags': metadata['tags'],
+        'abstract': abstract,
+        'search_body': body,
+        'post_body': post['body'],
+        'post_json_metadata': json.dumps(post['json_metadata'])
+    }
+
+def write_batch(cur,records):
+    # store a batch of prepared edits with multi-row statements, edits that
+    # are already stored are skipped. Returns the records written.
+    if len(records) == 0:
+        return records
+    cur.execute('SELECT trx_id FROM comments WHERE trx_id = ANY(%s)',
+        ([r['op']['trx_id'] for r in records],))
+    stored = set(row[0] for row in cur.fetchall())
+    records = [r for r in records if r['op']['trx_id'] not in stored]
+    if len(records) == 0:
+        return records
+    permlinks = list(set(r['op']['permlink'] for r in records))
+    cur.execute('SELECT permlink, count(*) FROM comments WHERE permlink = ANY(%s) GROUP BY permlink',
+        (permlinks,))
+    revisions = dict(cur.fetchall())
+    comments = []
+    latest = {}
+    for r in records:
+        op = r['op']
+        revisions[op['permlink']] = revisions.get(op['permlink'],0)+1
+        r['revision'] = revisions[op['permlink']]
+        comments.append((op['trx_id'],op['permlink'],r['timestamp'],r['metadata']['appdata']['user'],op['title'],op['body'],op['json_metadata'],r['revision']))
+        latest[op['permlink']] = r
+    execute_values(cur,'INSERT INTO comments (trx_id, permlink, timestamp, author, title, body, json_metadata, revision) VALUES %s'
+        ' ON CONFLICT(trx_id) DO NOTHING',comments)
+    for r in records:
+        if(r['revision'] % snapshot_interval == 0):
+            materializeRevision(cur,r['op']['permlink'],r['timestamp'],snapshot_interval,
+                lambda trx_id: transactions.get(cur,trx_id,hive.get_transaction)['operations'][0]['value']['body'])
+    posts = []
+    for permlink, r in latest.items():
+        op = r['op']
+        posts.append((permlink, op['title'], ' '.join(r['tags']), r['abstract'], r['search_body'],
+            op['title'], op['trx_id'], r['timestamp'], r['metadata']['appdata']['user'], r['revision'], r['abstract'], r['post_body'], r['post_json_metadata']))
+    upsert_posts(cur,posts)
+    index_links(cur,[(permlink, r['post_body']) for permlink, r in latest.items()])
+    update_categories(cur,dict((permlink, r['tags']) for permlink, r in latest.items()))
+    for r in records:
+        queue_announcements(cur,r)
+    return records
+
+def upsert_posts(cur,posts):
+    # rows of (permlink, title, tags, abstract, search body, title, trx_id,
+    # last_modified, last_author, revisions, abstract, body, json_metadata),
+    # the first five are weighted into the search vector
+    execute_values(cur,'INSERT INTO posts (permlink, tsvector, title, trx_id, last_modified, last_author, revisions, abstract, body, json_metadata) VALUES %s'
+        ' ON CONFLICT(permlink) DO UPDATE SET tsvector = EXCLUDED.tsvector, title = EXCLUDED.title, trx_id = EXCLUDED.trx_id,'
+        ' last_modified = EXCLUDED.last_modified, last_author = EXCLUDED.last_author, revisions = EXCLUDED.revisions, abstract = EXCLUDED.abstract,'
+        ' body = EXCLUDED.body, json_metadata = EXCLUDED.json_metadata',
+        posts,
+        template="(%s, setweight(to_tsvector(coalesce(%s,'')), 'A') || setweight(to_tsvector(coalesce(%s,'')), 'B') || setweight(to_tsvector(coalesce(%s,'')), 'C') || setweight(to_tsvector(coalesce(%s,'')), 'D'),"
+            " %s, %s, %s, %s, %s, %s, %s, %s)")
+
+def get_cursor(cur,name='follow'):
+    # position of the last processed operation: (block_num, trx_num, op_num),
+    # trx_num and op_num are None once the whole block is processed
+    cur.execute('SELECT block_num, trx_num, op_num FROM updater_state WHERE name=%s',(name,))
+    return cur.fetchone()
+
+def set_cursor(cur,block_num,trx_num=None,op_num=None,name='follow'):
+    cur.execute('INSERT INTO updater_state (name, block_num, trx_num, op_num) VALUES (%s, %s, %s, %s)'
+        ' ON CONFLICT(name) DO UPDATE SET block_num = EXCLUDED.block_num, trx_num = EXCLUDED.trx_num, op_num = EXCLUDED.op_num',
+        (name,block_num,trx_num,op_num))
+
+def initial_block(cur):
+    # the block of the newest edit already in the database, or of the
+    # creation of the wiki account
+    acc = Account(conf['WIKI_USER'], blockchain_instance=client)
+    cur.execute('SELECT trx_id FROM comments ORDER BY timestamp DESC LIMIT 1')
+    newest = cur.fetchone()
+    if newest is not None:
+        for op in acc.history_reverse(only_ops=['comment']):
+            if op['trx_id'] == newest[0]:
+                return op['block']
+    for op in acc.history(use_block_num=False,start=0,stop=1):
+        return op['block']
+
+def stream_ops(start,stop):
+    # operations relevant to the wiki in blocks start to stop, with their
+    # position in the block
+    last = None
+    op_num = 0
+    for op in hive.stream(opNames=['comment','account_update','account_update2'],start=start,stop=stop,max_batch_size=max_batch_size):
+        if (op['block_num'],op['trx_num']) == last:
+            op_num += 1
+        else:
+            last = (op['block_num'],op['trx_num'])
+            op_num = 0
+        yield (op['block_num'],op['trx_num'],op_num), op
+
+# follow irreversible blocks (or the head block, UPDATER_MODE = 'head')
+hive = Blockchain(blockchain_instance=client, mode=conf.get('UPDATER_MODE','irreversible'))
+w = Wallet(blockchain_instance=client)
+block_range = int(conf.get('UPDATER_BLOCK_RANGE','100'))
+max_batch_size = int(conf.get('UPDATER_MAX_BATCH_SIZE','50'))
+batch_size = int(conf.get('UPDATER_BATCH_SIZE','100'))
+key_cache_ttl = int(conf.get('UPDATER_KEY_CACHE_TTL','86400'))
+
+# signature recovery runs in worker processes, they are forked right away
+# while this is the only thread
+verify_pool = ProcessPoolExecutor(int(conf.get('UPDATER_VERIFY_WORKERS',str(os.cpu_count() or 1))),
+    mp_context=multiprocessing.get_context('fork'))
+verify_pool.submit(int).result()
+fetch_pool = ThreadPoolExecutor(int(conf.get('UPDATER_FETCH_WORKERS','8')))
+worker = threading.local()
+
+def fetch_history(start,stop):
+    # edits in blocks start to stop from the history of the wiki account, run
+    # in the fetch pool
+    acc = Account(conf['WIKI_USER'], blockchain_instance=worker_client())
+    ops = []
+    for op in acc.history(start=start,stop=stop,use_block_num=True,only_ops=['comment'],batch_size=1000):
+        if is_edit(op):
+            op['timestamp'] = formatTimeString(op['timestamp'])
+            ops.append(op)
+    return ops
+
+def history_ops(start,stop):
+    # edits in blocks start to stop, fetched in reindex_workers parallel ranges
+    step = (stop-start) // reindex_workers + 1
+    ranges = [(block, min(stop, block+step-1)) for block in range(start, stop+1, step)]
+    return list(chain.from_iterable(fetch_pool.map(lambda r: fetch_history(*r), ranges)))
+
+def reindex_edits(cur,ops):
+    # bulk insert edits read from the account history. Authors are checked
+    # like in prepare_comment() but nothing is revoked or announced, revision
+    # numbers are assigned by rebuild_posts().
+    comments = []
+    for op, (post, public_keys) in zip(ops,submit_edits(cur,ops,fetch_posts=False)):
+        metadata = edit_metadata(op)
+        if signing_account(cur,public_keys.result()) != metadata['appdata']['user']:
+            metadata['appdata']['user'] = None
+        comments.append((op['trx_id'],op['permlink'],op['timestamp'].replace(tzinfo=None),metadata['appdata']['user'],op['title'],op['body'],op['json_metadata']))
+    execute_values(cur,'INSERT INTO comments (trx_id, permlink, timestamp, author, title, body, json_metadata) VALUES %s'
+        ' ON CONFLICT(trx_id) DO NOTHING',comments,page_size=1000)
+
+def rebuild_posts(cur):
+    # posts and categories from the stored edits. The latest revision of every
+    # article is materialized, which stores its snapshots on the way.
+    number_revisions(cur)
+    cur.execute('SELECT DISTINCT ON (permlink) permlink, trx_id, timestamp, author, title, json_metadata, revision'
+        ' FROM comments ORDER BY permlink, timestamp DESC')
+    latest = cur.fetchall()
+    posts = []
+    bodies = []
+    tags = {}
+    for permlink, trx_id, timestamp, author, title, json_metadata, revision in latest:
+        body = materializeRevision(cur,permlink,timestamp,snapshot_interval,
+            lambda trx_id: transactions.get(cur,trx_id,hive.get_transaction)['operations'][0]['value']['body'])
+        abstract, search_body = split_abstract(body)
+        tags[permlink] = json.loads(json_metadata).get('tags',[])
+        posts.append((permlink, title, ' '.join(tags[permlink]), abstract, search_body,
+            title, trx_id, timestamp, author, revision, abstract, body, json_metadata))
+        bodies.append((permlink, body))
+        if len(posts) >= batch_size:
+            upsert_posts(cur,posts)
+            index_links(cur,bodies)
+            posts = []
+            bodies = []
+    if len(posts) > 0:
+        upsert_posts(cur,posts)
+        index_links(cur,bodies)
+    update_categories(cur,tags)
+
+def reindex():
+    # rebuild posts, comments and categories from the history of the wiki
+    # account, reindex_range blocks per transaction. The position is kept as
+    # the reindex cursor, an interrupted run continues there. When the head
+    # is reached the follow cursor is set and the updater carries on live.
     cur = conn.cursor()
-    try:
-        acc = Account(conf['WIKI_USER'], blockchain_instance=client)
-        hive = Blockchain(blockchain_instance=client)
-        w = Wallet(blockchain_instance=client)
-        ophistory = acc.history(only_ops=['comment'],start=startblock-1)
-    except Exception as e:
-        ophistory = {}
-
-    for op in ophistory:
-        cur.execute('SELECT trx_id FROM comments WHERE trx_id=%s',(op['trx_id'],))
-        try: 
-            exists = cur.fetchall()[0]
-        except:
-            exists = False
-        # Only process comments that don't exist yet, were authored by the wiki user in the category wiki
-        if(exists == False and op['type'] == 'comment' and op['author'] == conf['WIKI_USER'] and op['parent_permlink'] == 'wiki' and op['block'] != startblock):
-            pprint('Processing transaction '+op['trx_id'])
-
-            metadata = json.loads(op['json_metadata'])
-            if 'appdata' not in metadata or 'user' not in metadata['appdata']:
-                metadata['appdata']['user'] = None
-
-            transaction = Signed_Transaction(hive.get_transaction(op['trx_id']))
-            signer = ''
-            for key in transaction.verify(chain='HIVE2'):
-                owner = w.getAccountFromPublicKey('STM'+str(Base58(data=key)))
-                if(owner != None):
-                    signer = owner
-            try:
-                if(signer == metadata['appdata']['user']):
-                    s = True
-                else:
-                    s = False
-            except:
-                s = False
-            if(s == False):
-                pprint("User in metadata isn't signer. Removing signer's access.")
-                webhook_send("User in metadata didn't sign the transaction. Removing authorization for "+signer)
-                account = Account(conf['WIKI_USER'], blockchain_instance=client)
-                for i, auth in enumerate(account["posting"]["account_auths"]):
-                    if(auth[0] == signer):
-                        account['posting']['account_auths'].pop(i)
-                        op = operations.Account_update(**{"account": conf['WIKI_USER'],
-                            "posting": account["posting"],
-                            "memo_key": account["memo_key"],
-                            "json_metadata": account["json_metadata"]})
-                        tx = TransactionBuilder()
-                        tx.appendOps(op)
-                        tx.appendWif(conf['ACTIVE_KEY'])
-                        tx.sign()
-                        tx.broadcast()
-                        break
-                metadata['appdata']['user'] = None
-            
-            post = {}
-            while post == {}:
-                try:
-                    post = Comment(conf['WIKI_USER']+"/"+op['permlink'], blockchain_instance=client)
-                except:
-                    time.sleep(1)
-            tags = metadata['tags']
-            abstract = ''
-            body = post['body']
-            split = post['body'].split("\n## ",1)
-            if(len(split) > 1):
-                abstract = split[0]
-                body = split[1]
-            cur.execute('INSERT INTO posts (permlink, tsvector)'
-                " VALUES (%s, setweight(to_tsvector(coalesce(%s,'')), 'A') || setweight(to_tsvector(coalesce(%s,'')), 'B') || setweight(to_tsvector(coalesce(%s,'')), 'C') || setweight(to_tsvector(coalesce(%s,'')), 'D'))"
-                ' ON CONFLICT(permlink) DO UPDATE SET tsvector = EXCLUDED.tsvector',
-                (op['permlink'], op['title'], ' '.join(tags), abstract, body))
-            cur.execute('INSERT INTO comments (trx_id, permlink, timestamp, author)'
-                ' VALUES (%s, %s, %s, %s)'
-                ' ON CONFLICT(trx_id) DO NOTHING',
-                (op['trx_id'],op['permlink'],op['timestamp'],metadata['appdata']['user']))
-            cur.execute('DELETE FROM categories_posts WHERE permlink=%s',
-                (op['permlink'],))
-            for tag in tags:
-                if(tag != 'wiki' and tag != ''):
-                    cur.execute('INSERT INTO categories (category)'
-                        ' VALUES (%s)'
-                        ' ON CONFLICT(category) DO NOTHING',
-                        (tag,))
-                    cur.execute('INSERT INTO categories_posts (permlink, category)'
-                        ' VALUES (%s,%s)',
-                        (op['permlink'],tag))
-                    
-            webhook_text = 'New edit by '+metadata['appdata']['user']+' on article '+op['title']
-            if 'reason' in metadata['appdata']:
-                webhook_text += ' ('+metadata['appdata']['reason']+')'
-            rev_link = 'https://propol.is/history/'+formatPostLink(op['permlink'])+'/revision/'+op['trx_id']
-            webhook_text += ' '+rev_link
-            try:
-                webhook_send(webhook_text)
-                send_to_waves(op['title'],metadata,rev_link,op['permlink'])
-            except Exception as error:
-                pprint(error)
-
-        startblock = op['block']
+    position = get_cursor(cur,'reindex')
+    if position is None:
+        pprint('Starting reindex')
+        cur.execute('TRUNCATE posts, comments, categories, categories_posts, links')
+        cur.execute("DELETE FROM updater_state WHERE name='follow'")
+        set_cursor(cur,initial_block(cur)-1,name='reindex')
+        conn.commit()
+        position = get_cursor(cur,'reindex')
+    while 1 == 1:
+        try:
+            head = hive.get_current_block_num()
+            start = position[0]+1
+            if start > head:
+                break
+            stop = min(head, start+reindex_range-1)
+            reindex_edits(cur,history_ops(start,stop))
+            set_cursor(cur,stop,name='reindex')
+            conn.commit()
+            pprint('Reindexed blocks up to '+str(stop)+' of '+str(head))
+            position = (stop,)
+        except Exception as error:
+            pprint(error)
+            conn.rollback()
+            time.sleep(3)
+    rebuild_posts(cur)
+    set_cursor(cur,position[0])
+    cur.execute("DELETE FROM updater_state WHERE name='reindex'")
+    conn.commit()
+    publish_ingest_cursor(position)
+    cur.close()
+    pprint('Reindex done, following from block '+str(position[0]+1))
 
+reindex_range = int(conf.get('UPDATER_REINDEX_RANGE','100000'))
+reindex_workers = int(conf.get('UPDATER_REINDEX_WORKERS','4'))
+cur = conn.cursor()
+resume = get_cursor(cur,'reindex') is not None
+cur.execute('SELECT EXISTS (SELECT 1 FROM comments)')
+empty = not cur.fetchone()[0] and get_cursor(cur) is None
+cur.close()
+if sys.argv[1:2] == ['reindex'] or resume or empty:
+    reindex()
+
+def commit_batch(cur,batch,position=None):
+    # write a batch and the position of its last op in one transaction. The
+    # rendered pages of the edited articles and of the ones linking to new
+    # articles are dropped. Without a position the follow cursor is left as it is.
+    written = write_batch(cur,batch)
+    created = [r['op']['permlink'] for r in written if r['revision'] == 1]
+    linking = relink_articles(cur,created) if len(created) > 0 else []
+    if position is not None:
+        set_cursor(cur,*position)
     conn.commit()
+    for permlink in set(r['op']['permlink'] for r in written) | set(linking):
+        invalidate_render_cache(permlink)
+    if len(written) > 0 and position is not None:
+        publish_ingest_cursor(position)
+
+def catch_up(cur):
+    # the edits since the newest stored one are read from the history of the
+    # wiki account, reindex_range blocks at a time, instead of streaming every
+    # block. The follow cursor is set at the head block once they are stored,
+    # an interrupted run starts over at the newest stored edit.
+    start = initial_block(cur)
+    while 1 == 1:
+        head = hive.get_current_block_num()
+        stop = min(head, start+reindex_range-1)
+        ops = history_ops(start,stop)
+        batch = []
+        for op, (post, public_keys) in zip(ops,submit_edits(cur,ops)):
+            batch.append(prepare_comment(cur,op,public_keys.result(),post))
+        if stop == head:
+            commit_batch(cur,batch,(stop,))
+            return
+        commit_batch(cur,batch)
+        pprint('Caught up to block '+str(stop)+' of '+str(head))
+        start = stop+1
+
+cur = conn.cursor()
+while get_cursor(cur) is None:
+    try:
+        catch_up(cur)
+    except Exception as error:
+        pprint(error)
+        conn.rollback()
+        time.sleep(3)
+cur.close()
+
+while 1 == 1:
+    cur = conn.cursor()
+    try:
+        position = get_cursor(cur)
+        start = position[0] if position[1] is not None else position[0]+1
+        head = hive.get_current_block_num()
+        if start > head:
+            conn.rollback()
+            cur.close()
+            time.sleep(3)
+            continue
+        stop = min(head, start+block_range-1)
+        ops = [(pos, op) for pos, op in stream_ops(start,stop) if position[1] is None or pos > tuple(position)]
+        edits = iter(submit_edits(cur,[op for pos, op in ops if is_edit(op)]))
+        batch = []
+        for pos, op in ops:
+            if(op['type'] in ['account_update','account_update2']):
+                invalidate_keys(cur,op)
+                if(op['account'] == conf['WIKI_USER']):
+                    invalidate_authorities()
+            elif is_edit(op):
+                post, public_keys = next(edits)
+                batch.append(prepare_comment(cur,op,public_keys.result(),post))
+                if len(batch) >= batch_size:
+                    commit_batch(cur,batch,pos)
+                    batch = []
+        commit_batch(cur,batch,(stop,))
+    except Exception as error:
+        pprint(error)
+        conn.rollback()
+        cur.close()
+        time.sleep(3)
+        continue
     cur.close()
-    time.sleep(3)
 
 conn.close()
\ No newline at end of file
@@ -6,6 +6,10 @@ from flask_session import Session
 import redis
 
 from . import wiki
+from .db import ConnectionPool
+from .cache import AuthorityCache, DiffCache, RenderCache, SearchCache, TalkCache
+from .suggest import TitleIndex
+from .transactions import TransactionCache
 
 from .hive_keychain_auth.auth import hive_keychain_auth
 
@@ -20,6 +24,27 @@ def create_app():
         SESSION_REDIS='redis://127.0.0.1:6379',
         SESSION_USE_SIGNER=True,
         DB_HOSTNAME='localhost',
+        DB_POOL_MIN=1,
+        DB_POOL_MAX=8,
+        DB_POOL_IDLE_TIMEOUT=300,
+        DB_POOL_CHECK_INTERVAL=30,
+        DB_CONNECT_TIMEOUT=5,
+        RENDER_CACHE_SIZE=1000,
+        RENDER_CACHE_TTL=86400,
+        ACTIVITY_PAGE_SIZE=100,
+        AUTHORITY_CACHE_TTL=300,
+        CHAIN_FALLBACK=True,
+        REVISION_SNAPSHOT_INTERVAL=25,
+        TRANSACTION_CACHE_SIZE=1024,
+        COMPARE_CACHE_TTL=604800,
+        SITEMAP_SIZE=50000,
+        IMMUTABLE_MAX_AGE=31536000,
+        SEARCH_PAGE_SIZE=20,
+        SEARCH_CACHE_TTL=3600,
+        SUGGEST_REFRESH_INTERVAL=10,
+        SUGGEST_FUZZY=True,
+        TALK_CACHE_TTL=60,
+        TALK_CACHE_STALE_TTL=86400,
         HIVE_INTERFACE="https://hive.blog",
         START_PAGE='Welcome-To-Propolis-Wiki',
         EDIT_GUIDELINES='How-To-Edit-Propolis-Wiki'
@@ -29,6 +54,40 @@ def create_app():
     app.config['SESSION_REDIS'] = redis.from_url(app.config['SESSION_REDIS'])
     app.secret_key = app.config['SECRET_KEY']
 
+    app.extensions['db_pool'] = ConnectionPool(
+        app.config['DB_POOL_MIN'],
+        app.config['DB_POOL_MAX'],
+        idle_timeout=app.config['DB_POOL_IDLE_TIMEOUT'],
+        check_interval=app.config['DB_POOL_CHECK_INTERVAL'],
+        connect_timeout=app.config['DB_CONNECT_TIMEOUT'],
+        host=app.config['DB_HOSTNAME'],
+        database=app.config['DATABASE'],
+        user=app.config['DB_USERNAME'],
+        password=app.config['DB_PASSWORD'])
+    app.extensions['render_cache'] = RenderCache(
+        app.config['SESSION_REDIS'],
+        max_entries=app.config['RENDER_CACHE_SIZE'],
+        ttl=app.config['RENDER_CACHE_TTL'])
+    app.extensions['authority_cache'] = AuthorityCache(
+        app.config['SESSION_REDIS'],
+        app.config['WIKI_USER'],
+        ttl=app.config['AUTHORITY_CACHE_TTL'])
+    app.extensions['transaction_cache'] = TransactionCache(app.config['TRANSACTION_CACHE_SIZE'])
+    app.extensions['diff_cache'] = DiffCache(
+        app.config['SESSION_REDIS'],
+        ttl=app.config['COMPARE_CACHE_TTL'])
+    app.extensions['search_cache'] = SearchCache(
+        app.config['SESSION_REDIS'],
+        ttl=app.config['SEARCH_CACHE_TTL'])
+    app.extensions['talk_cache'] = TalkCache(
+        app.config['SESSION_REDIS'],
+        ttl=app.config['TALK_CACHE_TTL'],
+        stale_ttl=app.config['TALK_CACHE_STALE_TTL'])
+    app.extensions['title_index'] = TitleIndex(
+        app.config['SESSION_REDIS'],
+        refresh_interval=app.config['SUGGEST_REFRESH_INTERVAL'])
+    app.extensions['title_index'].start(app, wiki.db_get_all)
+
     @app.errorhandler(404)
     def page_not_found(e):
         return render_template("404.html")
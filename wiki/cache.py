@@ -0,0 +1,273 @@
+import json
+import threading
+import time
+
+import redis
+
+from beem.account import Account
+
+class RenderCache:
+    """Sanitized article bodies in redis, one entry per permlink.
+
+    An entry is only valid for the revision (trx_id) it was rendered from.
+    The cache holds at most max_entries articles, the least recently read
+    ones are dropped first, and every entry expires after ttl seconds.
+    """
+
+    prefix = 'wiki:render:'
+    lru = 'wiki:render-lru'
+
+    def __init__(self, client, max_entries=1000, ttl=86400):
+        self.client = client
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def key(self, permlink):
+        return self.prefix+permlink
+
+    def get(self, permlink, trx_id):
+        try:
+            data = self.client.get(self.key(permlink))
+            if data is None:
+                return None
+            entry = json.loads(data)
+            if entry['trx_id'] != trx_id:
+                return None
+            self.client.zadd(self.lru, {permlink: time.time()})
+            return entry
+        except redis.RedisError:
+            return None
+
+    def set(self, permlink, trx_id, entry):
+        entry = dict(entry, trx_id=trx_id)
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(self.key(permlink), json.dumps(entry), ex=self.ttl)
+            pipe.zadd(self.lru, {permlink: time.time()})
+            pipe.zcard(self.lru)
+            size = pipe.execute()[-1]
+            if size > self.max_entries:
+                self.evict(size - self.max_entries)
+        except redis.RedisError:
+            pass
+
+    def evict(self, count):
+        oldest = self.client.zrange(self.lru, 0, count-1)
+        if oldest:
+            pipe = self.client.pipeline()
+            pipe.delete(*[self.key(permlink.decode()) for permlink in oldest])
+            pipe.zrem(self.lru, *oldest)
+            pipe.execute()
+
+    def invalidate(self, permlink):
+        try:
+            pipe = self.client.pipeline()
+            pipe.delete(self.key(permlink))
+            pipe.zrem(self.lru, permlink)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def size(self):
+        try:
+            return self.client.zcard(self.lru)
+        except redis.RedisError:
+            return None
+
+class AuthorityCache:
+    """Posting account_auths of the wiki account as {username: userlevel}.
+
+    Kept in process for local_ttl seconds and shared between processes in
+    redis for ttl seconds, so only one process per ttl asks a Hive node.
+    """
+
+    key = 'wiki:account-auths'
+
+    def __init__(self, client, account, ttl=300, local_ttl=10):
+        self.client = client
+        self.account = account
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self._auths = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._auths is not None and time.monotonic() - self._loaded < self.local_ttl:
+            return self._auths
+        with self._lock:
+            if self._auths is not None and time.monotonic() - self._loaded < self.local_ttl:
+                return self._auths
+            auths = None
+            try:
+                data = self.client.get(self.key)
+                if data is not None:
+                    auths = json.loads(data)
+            except redis.RedisError:
+                pass
+            if auths is None:
+                auths = self.fetch()
+            self._auths = auths
+            self._loaded = time.monotonic()
+            return auths
+
+    def fetch(self):
+        return self.store(Account(self.account)["posting"]["account_auths"])
+
+    def store(self, account_auths):
+        auths = dict((auth[0], auth[1]) for auth in account_auths)
+        try:
+            self.client.set(self.key, json.dumps(auths), ex=self.ttl)
+        except redis.RedisError:
+            pass
+        self._auths = auths
+        self._loaded = time.monotonic()
+        return auths
+
+class DiffCache:
+    """Rendered comparisons of two revisions in redis.
+
+    Revisions never change, so entries are only dropped after ttl seconds.
+    """
+
+    prefix = 'wiki:compare:'
+
+    def __init__(self, client, ttl=604800):
+        self.client = client
+        self.ttl = ttl
+
+    def get(self, revision_1, revision_2):
+        try:
+            data = self.client.get(self.prefix+revision_1+':'+revision_2)
+        except redis.RedisError:
+            return None
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def set(self, revision_1, revision_2, entry):
+        try:
+            self.client.set(self.prefix+revision_1+':'+revision_2, json.dumps(entry), ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+class SearchCache:
+    """Pages of search results in redis.
+
+    Entries are keyed by the ingest cursor the updater publishes after
+    writing edits, so a new edit starts a new generation of keys and old
+    ones expire after ttl seconds.
+    """
+
+    prefix = 'wiki:search:'
+    cursor_key = 'wiki:ingest-cursor'
+
+    def __init__(self, client, ttl=3600):
+        self.client = client
+        self.ttl = ttl
+
+    def key(self, cursor, query, page):
+        return self.prefix+cursor+':'+str(page)+':'+query
+
+    def get(self, query, page):
+        # (cursor, entry or None), cursor is None if redis isn't available
+        try:
+            cursor = self.client.get(self.cursor_key)
+            cursor = cursor.decode() if cursor is not None else ''
+            data = self.client.get(self.key(cursor, query, page))
+        except redis.RedisError:
+            return None, None
+        if data is None:
+            return cursor, None
+        return cursor, json.loads(data)
+
+    def set(self, cursor, query, page, entry):
+        try:
+            self.client.set(self.key(cursor, query, page), json.dumps(entry), ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+class TalkCache:
+    """Sanitized replies of talk pages in redis.
+
+    The summaries of the replies to an article are one entry and their
+    bodies a hash next to it, so a page is shown without the bodies. An
+    entry is fresh for ttl seconds and kept for stale_ttl. Once it is stale
+    it is still served while one process fetches the replies again in a
+    thread.
+    """
+
+    prefix = 'wiki:talk:'
+    bodies_prefix = 'wiki:talk-bodies:'
+    lock_prefix = 'wiki:talk-refresh:'
+
+    def __init__(self, client, ttl=60, stale_ttl=86400):
+        self.client = client
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    @staticmethod
+    def summaries(replies):
+        return [dict((k, v) for k, v in reply.items() if k != 'body') for reply in replies]
+
+    def get(self, permlink, fetch):
+        # summaries of the replies to permlink, fetch() returns the replies
+        # with their bodies when they aren't cached or stale
+        try:
+            data = self.client.get(self.prefix+permlink)
+        except redis.RedisError:
+            return self.summaries(fetch())
+        if data is None:
+            return self.summaries(self.store(permlink, fetch()))
+        entry = json.loads(data)
+        if time.time() - entry['fetched'] > self.ttl and self.lock(permlink):
+            threading.Thread(target=self.revalidate, args=(permlink, fetch), daemon=True).start()
+        return entry['replies']
+
+    def body(self, permlink, author, reply_permlink, fetch):
+        # sanitized body of a reply, None if there is no such reply. The
+        # replies are only fetched if they aren't cached at all.
+        try:
+            body = self.client.hget(self.bodies_prefix+permlink, author+'/'+reply_permlink)
+            if body is not None:
+                return body.decode()
+            if self.client.exists(self.prefix+permlink):
+                return None
+        except redis.RedisError:
+            pass
+        for reply in self.store(permlink, fetch()):
+            if reply['author'] == author and reply['permlink'] == reply_permlink:
+                return reply['body']
+        return None
+
+    def lock(self, permlink):
+        try:
+            return bool(self.client.set(self.lock_prefix+permlink, 1, nx=True, ex=60))
+        except redis.RedisError:
+            return False
+
+    def revalidate(self, permlink, fetch):
+        try:
+            self.store(permlink, fetch())
+        except Exception:
+            pass
+        finally:
+            try:
+                self.client.delete(self.lock_prefix+permlink)
+            except redis.RedisError:
+                pass
+
+    def store(self, permlink, replies):
+        entry = {'fetched': time.time(), 'replies': self.summaries(replies)}
+        bodies = dict((reply['author']+'/'+reply['permlink'], reply['body']) for reply in replies)
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(self.prefix+permlink, json.dumps(entry), ex=self.stale_ttl)
+            pipe.delete(self.bodies_prefix+permlink)
+            if bodies:
+                pipe.hset(self.bodies_prefix+permlink, mapping=bodies)
+                pipe.expire(self.bodies_prefix+permlink, self.stale_ttl)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+        return replies
@@ -0,0 +1,185 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+class PoolExhausted(Exception):
+    pass
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool shared by all requests of a process.
+
+    Keeps at least minconn connections open, never more than maxconn.
+    Connections idle for longer than idle_timeout are closed (down to minconn),
+    connections idle for longer than check_interval are pinged before reuse.
+    Opening a connection gives up after connect_timeout seconds. Idle
+    connections are also evicted by a daemon thread every idle_timeout
+    seconds, so a process without requests doesn't keep them open.
+    """
+
+    def __init__(self, minconn, maxconn, idle_timeout=300, check_interval=30, wait_timeout=10, connect_timeout=5, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.connect_timeout = connect_timeout
+        self._kwargs = kwargs
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'closed': 0,
+            'evicted': 0,
+            'failed_checks': 0,
+            'borrowed': 0,
+            'waits': 0,
+            'timeouts': 0
+        }
+        for i in range(minconn):
+            try:
+                self._idle.append((self._connect(), time.monotonic()))
+                self._stats['created'] += 1
+            except psycopg2.Error:
+                break
+        self._reaper = threading.Thread(target=self._reap, name='db-pool-reaper', daemon=True)
+        self._reaper.start()
+
+    def _connect(self):
+        conn = psycopg2.connect(connect_timeout=self.connect_timeout, **self._kwargs)
+        conn.autocommit = True
+        return conn
+
+    def _close(self, conn):
+        # called outside of the lock, the caller counts it in closed
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _evict_idle(self):
+        # under the lock, returns the connections to close once it is released.
+        # Idle connections are kept oldest first, reuse takes the newest
+        now = time.monotonic()
+        evicted = []
+        while self._idle and len(self._idle) + self._in_use > self.minconn:
+            conn, last_used = self._idle[0]
+            if now - last_used <= self.idle_timeout:
+                break
+            self._idle.pop(0)
+            evicted.append(conn)
+        self._stats['evicted'] += len(evicted)
+        self._stats['closed'] += len(evicted)
+        return evicted
+
+    def _reap(self):
+        while True:
+            time.sleep(max(self.idle_timeout, 1))
+            with self._cond:
+                evicted = self._evict_idle()
+            for conn in evicted:
+                self._close(conn)
+
+    def getconn(self):
+        # a slot is reserved under the lock, the connection is checked or
+        # opened outside of it so a slow database doesn't block other threads
+        deadline = time.monotonic() + self.wait_timeout
+        conn = None
+        evicted = []
+        try:
+            with self._cond:
+                while True:
+                    evicted += self._evict_idle()
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        self._in_use += 1
+                        break
+                    if self._in_use < self.maxconn:
+                        self._in_use += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolExhausted('No database connection available after %ss' % self.wait_timeout)
+                    self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+        finally:
+            for evicted_conn in evicted:
+                self._close(evicted_conn)
+        if conn is not None:
+            if self._healthy(conn, last_used):
+                with self._cond:
+                    self._stats['borrowed'] += 1
+                return conn
+            self._close(conn)
+            with self._cond:
+                self._stats['failed_checks'] += 1
+                self._stats['closed'] += 1
+        try:
+            conn = self._connect()
+        except:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats['created'] += 1
+            self._stats['borrowed'] += 1
+        return conn
+
+    def putconn(self, conn, discard=False):
+        # the rollback and closing happen before the slot is given back
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        discard = discard or conn.closed
+        if discard:
+            self._close(conn)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._stats['closed'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            evicted = self._evict_idle()
+            self._cond.notify()
+        for evicted_conn in evicted:
+            self._close(evicted_conn)
+
+    def closeall(self):
+        with self._cond:
+            idle = self._idle
+            self._idle = []
+            self._stats['closed'] += len(idle)
+        for conn, last_used in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'min': self.minconn,
+                'max': self.maxconn,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'size': len(self._idle) + self._in_use
+            })
+            return stats
@@ -0,0 +1,30 @@
+import re
+
+wikiLink = re.compile(r'\[\[([^\]]+)\]\]')
+
+def isInternalLink(text, target):
+    # the markdown link restoreInternalLinks() turns into a [[]] wiki link
+    hasFragment = '#' in target and '|' in text
+    if not hasFragment:
+        return text.lower() == target.lower().replace('-',' ')
+    textNoFragment = text.lower().split('|')[0]
+    linkNoFragment = target.lower().split('#')[0].replace('-',' ')
+    fragmentText = text.lower().split('|')[1].replace(' ','')
+    fragmentLink = target.lower().split('#')[1]
+    return fragmentText == fragmentLink and textNoFragment == linkNoFragment
+
+def linkedPermlinks(body, wiki_user):
+    # permlinks of the articles a body links to, with [[]] wiki links or
+    # markdown links to the wiki account, code blocks left out. These are the
+    # articles whose existence decides the red links of its page.
+    text = ''.join(body.split('```')[0::2])
+    permlinks = set()
+    for link in wikiLink.findall(text):
+        permlinks.add('-'.join(link.split('|')[0].split(' ')).lower())
+    for link_text, target in re.findall(r'\[([^\[\]]+)\]\(/@%s/([^\(\)]+)\)' % re.escape(wiki_user), text):
+        if isInternalLink(link_text, target):
+            permlinks.add('-'.join(link_text.split('|')[0].split(' ')).lower())
+        else:
+            permlinks.add(target.split('#')[0].lower())
+    permlinks.discard('')
+    return permlinks
@@ -0,0 +1,71 @@
+import zlib
+
+import psycopg2
+
+from diff_match_patch import diff_match_patch
+
+# Revisions are rebuilt from the edits stored in comments. The body of an
+# edit is either the full text or a diff-match-patch patch to the revision
+# before it. Every snapshot interval a compressed full text (snapshot) is
+# kept with the edit, so a revision never needs more than interval patches.
+
+def compressSnapshot(body):
+    return psycopg2.Binary(zlib.compress(body.encode('utf-8')))
+
+def decompressSnapshot(snapshot):
+    return zlib.decompress(bytes(snapshot)).decode('utf-8')
+
+def applyEdit(dmp, body, edit_body):
+    try:
+        patch = dmp.patch_fromText(edit_body)
+    except ValueError:
+        return edit_body
+    if len(patch) == 0:
+        return body
+    return dmp.patch_apply(patch, body)[0]
+
+def materializeRevision(cur, permlink, timestamp, interval, fetch_body):
+    # text of the last edit of permlink at or before timestamp
+    return materializeRevisions(cur, permlink, [timestamp], interval, fetch_body)[0]
+
+def materializeRevisions(cur, permlink, timestamps, interval, fetch_body):
+    # texts of the last edits of permlink at or before each of timestamps, in
+    # one pass starting at the snapshot nearest to the oldest of them.
+    # Missing snapshots on the way are stored.
+    # fetch_body(trx_id) is called for edits whose body isn't stored.
+    first = min(timestamps)
+    last = max(timestamps)
+    cur.execute('SELECT trx_id, timestamp, revision, body, snapshot FROM comments WHERE permlink=%s AND timestamp <= %s'
+        ' AND timestamp >= coalesce((SELECT max(timestamp) FROM comments WHERE permlink=%s AND timestamp <= %s AND snapshot IS NOT NULL), \'-infinity\')'
+        ' ORDER BY timestamp ASC',
+        (permlink, last, permlink, first))
+    dmp = diff_match_patch()
+    body = ''
+    bodies = {}
+    for trx_id, edit_timestamp, revision, edit_body, snapshot in cur.fetchall():
+        if snapshot is not None:
+            body = decompressSnapshot(snapshot)
+        else:
+            if edit_body is None:
+                edit_body = fetch_body(trx_id)
+            body = applyEdit(dmp, body, edit_body)
+            if revision is not None and revision % interval == 0:
+                cur.execute('UPDATE comments SET snapshot=%s WHERE trx_id=%s', (compressSnapshot(body), trx_id))
+        for timestamp in timestamps:
+            if edit_timestamp <= timestamp:
+                bodies[timestamp] = body
+    return [bodies.get(timestamp, '') for timestamp in timestamps]
+
+def diffRevisions(body_1, body_2, line_mode_length=10000):
+    # diff from body_1 to body_2 as a list of (operation, text), operation is
+    # -1 for deletions, 1 for insertions and 0 for equal text. Long texts are
+    # diffed line by line first.
+    dmp = diff_match_patch()
+    if max(len(body_1), len(body_2)) > line_mode_length:
+        chars_1, chars_2, lines = dmp.diff_linesToChars(body_1, body_2)
+        diffs = dmp.diff_main(chars_1, chars_2, False)
+        dmp.diff_charsToLines(diffs, lines)
+    else:
+        diffs = dmp.diff_main(body_1, body_2)
+    dmp.diff_cleanupSemantic(diffs)
+    return diffs
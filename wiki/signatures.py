@@ -0,0 +1,11 @@
+from beembase.signedtransactions import Signed_Transaction
+from beemgraphenebase.base58 import Base58
+
+# Recovering the public keys from the signatures of a transaction is the
+# CPU-bound part of checking an edit. It only needs the transaction, so the
+# updater runs it in worker processes.
+
+def recoverPublicKeys(transaction):
+    # public keys that signed transaction, as STM... strings
+    keys = Signed_Transaction(dict(transaction)).verify(chain='HIVE2')
+    return ['STM'+str(Base58(data=key)) for key in keys]
@@ -58,3 +58,19 @@ document.getElementById('searchInput').addEventListener('keyup', function(e) {
         document.getElementById('submitSearch').click();
     }
 });
+
+document.getElementById('searchInput').addEventListener('input', function(e) {
+    let search = document.getElementById('searchInput').value;
+    if (search.trim() === '') {
+        return;
+    }
+    fetch('/api/suggest?q='+encodeURIComponent(search)).then(response => response.json()).then(suggestions => {
+        let list = document.getElementById('searchSuggestions');
+        list.innerHTML = '';
+        suggestions.forEach(suggestion => {
+            let option = document.createElement('option');
+            option.value = suggestion.title;
+            list.appendChild(option);
+        });
+    });
+});
@@ -17,7 +17,15 @@ function reverseChildren(parent) {
     }
 }
 
-function applyListeners(permlink) {
+function loadBody(element, url) {
+    // reply bodies are fetched when a reply is opened for the first time
+    fetch(url).then(response => response.json()).then(data => {
+        document.getElementById(element).innerHTML = data.body;
+        createViewer(element);
+    });
+}
+
+function applyListeners(permlink, url) {
     let header = document.getElementById("header_"+permlink);
     let body = document.getElementById("body_"+permlink);
     let collapse = document.getElementById("collapse_"+permlink);
@@ -26,12 +34,17 @@ function applyListeners(permlink) {
     let reply_link = document.getElementById("reply_link_"+permlink);
     let short = document.getElementById("short_"+permlink);
     let send = document.getElementById("reply_send_"+permlink);
+    let loaded = false;
 
     body.style.display = "none";      
     collapse.style.display = "none";
     reply.style.display = "none";
 
     header.addEventListener('click',function(){
+        if (!loaded) {
+            loaded = true;
+            loadBody("body_"+permlink+"_content", url);
+        }
         body.style.display = "block";
         collapse.style.display = "inline-block";
         short.style.display = "none";
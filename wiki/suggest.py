@@ -0,0 +1,140 @@
+import bisect
+import random
+import threading
+import time
+
+import redis
+
+from .cache import SearchCache
+
+class TitleIndex:
+    """Article titles for autocompletion and random articles, in process.
+
+    A sorted list of (key, permlink) is searched with bisect. Every word of
+    a title starts a key, so 'art' finds 'My Article'. Permlinks are also
+    kept in lists, all of them and per category, to pick random articles.
+    A thread loads all posts at startup and then only the ones modified
+    since, whenever the ingest cursor the updater publishes in redis changes.
+    """
+
+    def __init__(self, client, refresh_interval=10):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self._keys = []
+        self._titles = {}
+        self._categories = {}
+        self._permlinks = []
+        self._by_category = {}
+        self._newest = None
+        self._cursor = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.lower().replace('-', ' ').split())
+
+    def keys(self, permlink, title):
+        keys = set()
+        for text in [title, permlink]:
+            words = self.normalize(text).split(' ')
+            for i in range(len(words)):
+                keys.add((' '.join(words[i:]), permlink))
+        return keys
+
+    def update(self, rows):
+        # rows of (permlink, title, last_modified, categories), replacing
+        # known articles. The first load sorts the keys once, later ones
+        # insert them in place.
+        with self._lock:
+            bulk = len(self._titles) == 0
+            for permlink, title, last_modified, categories in rows:
+                if permlink in self._titles:
+                    for key in self.keys(permlink, self._titles[permlink]):
+                        i = bisect.bisect_left(self._keys, key)
+                        if i < len(self._keys) and self._keys[i] == key:
+                            del self._keys[i]
+                    for category in self._categories[permlink]:
+                        self._by_category[category].remove(permlink)
+                else:
+                    self._permlinks.append(permlink)
+                if bulk:
+                    self._keys.extend(self.keys(permlink, title))
+                else:
+                    for key in self.keys(permlink, title):
+                        bisect.insort(self._keys, key)
+                for category in categories:
+                    self._by_category.setdefault(category, []).append(permlink)
+                self._titles[permlink] = title
+                self._categories[permlink] = categories
+                if last_modified is not None and (self._newest is None or last_modified > self._newest):
+                    self._newest = last_modified
+            if bulk:
+                self._keys.sort()
+
+    def search(self, prefix, limit=10):
+        # [(permlink, title)] of titles with a word starting with prefix
+        prefix = self.normalize(prefix)
+        results = []
+        seen = set()
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(results) < limit:
+                key, permlink = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                if permlink not in seen:
+                    seen.add(permlink)
+                    results.append((permlink, self._titles[permlink]))
+                i += 1
+        return results
+
+    def random(self, category=None, disambiguation=True):
+        # a random permlink, of category if given, None if there is none.
+        # Disambiguation pages are few, so they are skipped by drawing again.
+        with self._lock:
+            permlinks = self._permlinks if category is None else self._by_category.get(category, [])
+            for i in range(10):
+                if len(permlinks) == 0:
+                    return None
+                permlink = random.choice(permlinks)
+                if disambiguation or 'disambiguation' not in permlink:
+                    return permlink
+            permlinks = [permlink for permlink in permlinks if 'disambiguation' not in permlink]
+            if len(permlinks) == 0:
+                return None
+            return random.choice(permlinks)
+
+    def size(self):
+        return len(self._titles)
+
+    def refresh(self, db_get_all):
+        try:
+            cursor = self.client.get(SearchCache.cursor_key)
+        except redis.RedisError:
+            cursor = None
+        if self._newest is not None and cursor is not None and cursor == self._cursor:
+            return
+        query = ('SELECT p.permlink, coalesce(p.title, p.permlink), p.last_modified,'
+            ' array(SELECT category FROM categories_posts cp WHERE cp.permlink = p.permlink) FROM posts p')
+        if self._newest is None:
+            rows = db_get_all(query)
+        else:
+            rows = db_get_all(query+' WHERE p.last_modified >= %s', (self._newest,))
+        self.update(rows)
+        self._cursor = cursor
+
+    def start(self, app, db_get_all):
+        # load now and keep refreshing in a daemon thread of this process
+        if self._thread is not None and self._thread.is_alive():
+            return
+        def run():
+            while True:
+                with app.app_context():
+                    try:
+                        self.refresh(db_get_all)
+                    except Exception as error:
+                        app.logger.warning('Loading the title index failed: %s', error)
+                time.sleep(self.refresh_interval)
+        self._thread = threading.Thread(target=run, name='title-index', daemon=True)
+        self._thread.start()
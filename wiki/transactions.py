@@ -0,0 +1,53 @@
+import copy
+import json
+import threading
+
+from collections import OrderedDict
+
+class TransactionCache:
+    """Results of get_transaction by trx_id.
+
+    Transactions don't change once they are in a block, so they are kept
+    for good in the transactions table, with an in process LRU of size
+    entries in front of it. Only a miss in both calls fetch(trx_id).
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cur, trx_id, fetch):
+        transaction = self.lookup(cur, [trx_id]).get(trx_id)
+        if transaction is None:
+            transaction = copy.deepcopy(self.store(cur, trx_id, fetch(trx_id)))
+        return transaction
+
+    def lookup(self, cur, trx_ids):
+        # the known transactions of trx_ids by trx_id, without fetching any
+        found = {}
+        with self._lock:
+            for trx_id in trx_ids:
+                if trx_id in self._lru:
+                    self._lru.move_to_end(trx_id)
+                    found[trx_id] = copy.deepcopy(self._lru[trx_id])
+        missing = [trx_id for trx_id in trx_ids if trx_id not in found]
+        if len(missing) > 0:
+            cur.execute('SELECT trx_id, data FROM transactions WHERE trx_id = ANY(%s)', (missing,))
+            for trx_id, transaction in cur.fetchall():
+                self._remember(trx_id, transaction)
+                found[trx_id] = copy.deepcopy(transaction)
+        return found
+
+    def store(self, cur, trx_id, transaction):
+        cur.execute('INSERT INTO transactions (trx_id, data) VALUES (%s, %s) ON CONFLICT(trx_id) DO NOTHING',
+            (trx_id, json.dumps(transaction)))
+        self._remember(trx_id, transaction)
+        return transaction
+
+    def _remember(self, trx_id, transaction):
+        with self._lock:
+            self._lru[trx_id] = transaction
+            self._lru.move_to_end(trx_id)
+            while len(self._lru) > self.size:
+                self._lru.popitem(last=False)
@@ -1,49 +1,49 @@
 from flask import (
-    Blueprint, Response, flash, redirect, render_template, url_for, request, session, current_app
+    Blueprint, Response, flash, g, jsonify, make_response, redirect, render_template, url_for, request, session, current_app
 )
 from werkzeug.exceptions import abort
 
 import time
+import datetime
 import json
 import re
+from contextlib import contextmanager
 
 import psycopg2
 
-from diff_match_patch import diff_match_patch
+from .revisions import diffRevisions, materializeRevision, materializeRevisions
+from .links import isInternalLink
 
 from beem.account import Account
 from beem.comment import Comment
 from beem.blockchain import Blockchain
 
-from markupsafe import Markup
+from markupsafe import Markup, escape
 import bleach
 
 bp = Blueprint('wiki', __name__)
 
+@contextmanager
 def get_db_connection():
-    conn = psycopg2.connect(host=current_app.config['DB_HOSTNAME'],
-                            database=current_app.config['DATABASE'],
-                            user=current_app.config['DB_USERNAME'],
-                            password=current_app.config['DB_PASSWORD'])
-    conn.autocommit = True
-    return conn
+    pool = current_app.extensions['db_pool']
+    conn = pool.getconn()
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        pool.putconn(conn, discard=True)
+        raise
+    except:
+        pool.putconn(conn)
+        raise
+    else:
+        pool.putconn(conn)
 
 def db_get_all(query,data = ()):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(query,data)
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
-    return result
-
-def db_count(query,data = ()):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(query,data)
-    result = cur.fetchone()[0]
-    cur.close()
-    conn.close()
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query,data)
+        result = cur.fetchall()
+        cur.close()
     return result
 
 def xssEscape(string):
@@ -76,7 +76,9 @@ def hive_account_update(account_data):
             "posting": account_data["posting"],
             "memo_key": account_data["memo_key"],
             "json_metadata": account_data["json_metadata"]})
-    return hive_broadcast(op)
+    result = hive_broadcast(op)
+    current_app.extensions['authority_cache'].store(account_data["posting"]["account_auths"])
+    return result
 
 def formatPostLink(permlink):
     permlink = permlink.replace('(','').replace(')','').replace(',','').replace(' ','').replace('+','')
@@ -134,7 +136,10 @@ def unformatWikiLink(link):
 
 def restoreSource(body):
     new_body, codeblocks = extractCodeBlocks(body)
-    new_body = restoreInternalLinks(new_body)
+    try:
+        new_body = restoreLinks(new_body)
+    except IrregularMarkup:
+        new_body = restoreInternalLinks(new_body)
     new_body = restoreCodeBlocks(new_body,codeblocks)
     return restoreReferences(new_body)
 
@@ -279,6 +284,13 @@ def wikifyHiveLinks(body):
     return body.replace('](/@', ']('+current_app.config['HIVE_INTERFACE']+'/@')
 
 def wikifyBody(body):
+    try:
+        return renderBody(body)
+    except IrregularMarkup:
+        return wikifyBodyStages(body)
+
+def wikifyBodyStages(body):
+    # one pass over the body per stage, renderBody() gives the same html
     new_body, codeblocks = extractCodeBlocks(restoreSource(body))
 
     new_body = wikifyReferences(new_body)
@@ -304,10 +316,11 @@ def getRelated(new_body):
 
     # create list of related links
     links = re.findall("\[\[([^\]]+)\]\]", new_body)
+    existing = getExistingPermlinks([unformatWikiLink(link.split('|')[0]) for link in links])
     for link in links:
         linkNoFragment = link.split('|')[0]
         rel = '[[%s]]' % formatWikiLink(linkNoFragment)
-        exists = db_count('SELECT count(permlink) FROM posts WHERE permlink=%s',(unformatWikiLink(linkNoFragment),))
+        exists = existing[unformatWikiLink(linkNoFragment)]
         existsDict[link] = exists
 
         title = linkNoFragment.lower()
@@ -329,55 +342,318 @@ def getRelated(new_body):
         new_body += rest
 
     return related, new_body
+
+class IrregularMarkup(Exception):
+    """Markup renderBody() doesn't render exactly like wikifyBodyStages()."""
+
+referenceTokens = re.compile(r'<ref>\|Reference: |<ref name=multiple>|<ref>|</ref>')
+linkTokens = re.compile(r'\[\[([^\]]+)\]\]|\[\[|\]\]')
+
+def restoreLinks(body):
+    # restoreInternalLinks() in a single pass. That replaces every occurrence of
+    # a link at once, so a link ends up as the first replacement touching it made
+    # it: [[text]] for the same markdown link or /wiki/ for a deviating link with
+    # the same text.
+    user = current_app.config['WIKI_USER']
+    pattern = r'\[([^\[\]]+)\]\(/@%s/([^\(\)]+)\)' % user
+    new_body = []
+    pos = 0
+    internal = {}
+    deviating = {}
+    for n, match in enumerate(re.finditer(pattern, body)):
+        text, target = match.groups()
+        if match.group(0) != '[%s](/@%s/%s)' % (text, user, target):
+            raise IrregularMarkup('link to another account')
+        if isInternalLink(text, target):
+            internal.setdefault(match.group(0), n)
+        else:
+            deviating.setdefault(text, n)
+        new_body.append(body[pos:match.start()])
+        first = internal.get(match.group(0))
+        if first is not None and first < deviating.get(text, n+1):
+            new_body.append('[[%s]]' % text)
+        else:
+            new_body.append('[%s](/wiki/%s)' % (text, target))
+        pos = match.end()
+    if body.count('](/@%s/' % user) != len(new_body)//2:
+        # an unclosed link the replacement of a deviating one would change too
+        raise IrregularMarkup('incomplete link')
+    new_body.append(body[pos:])
+    return ''.join(new_body).replace('<a href="/@'+user+'/','<a href="/wiki/')
+
+def tokenizeLinks(body, new_body, links, linked):
+    # appends text and [[]] links of body to new_body, the index of a link in
+    # new_body to links. linked tells if a link came before, after that every ]]
+    # has to close one
+    pos = 0
+    for token in linkTokens.finditer(body):
+        link = token.group(1)
+        if link is None:
+            if linked or token.group(0) == '[[':
+                raise IrregularMarkup('unclosed wiki link')
+            continue
+        if '[' in link or '<ref' in link or '</ref>' in link:
+            raise IrregularMarkup('wiki link')
+        new_body.append(body[pos:token.start()])
+        links.append(len(new_body))
+        new_body.append(link)
+        linked = True
+        pos = token.end()
+    new_body.append(body[pos:])
+    return linked
+
+def renderHeaders(body):
+    # wikifyHeaders() building lists
+    headers = body.split("\n## ")
+    if len(headers) == 1:
+        return body
+    sections = []
+    contents = ['<br><div class="contentsPanel"><div class="contentsHeader">Contents</div><ul>']
+    for i, val in enumerate(headers[1:], 1):
+        heading = val.split("\n",1)[0]
+        contents.append('<li><span>'+str(i)+'</span> <a href="#'+toHtmlId(heading)+'">'+heading+'</a>')
+        h3s = val.split("\n### ")
+        if len(h3s) > 1:
+            contents.append('<ul>')
+            section = [h3s[0]]
+            for j, h in enumerate(h3s[1:], 1):
+                z = h.split("\n",1)
+                if len(z) < 2:
+                    raise IrregularMarkup('heading without text')
+                section.append("\n### "+'<span id="'+toHtmlId(z[0])+'">'+z[0]+"</span>\n"+z[1])
+                contents.append('<li><span>'+str(i)+'.'+str(j)+'</span> <a href="#'+toHtmlId(z[0])+'">'+z[0]+'</a></li>')
+            contents.append('</ul>')
+            sections.append(''.join(section))
+        else:
+            z = val.split("\n",1)
+            if len(z) < 2:
+                raise IrregularMarkup('heading without text')
+            sections.append('<span id="'+toHtmlId(z[0])+'">'+z[0]+"</span>\n"+z[1])
+        contents.append('</li>')
+    contents.append('</ul></div>')
+    z = "\n## ".join(sections).split("\n",1)
+    if len(z) < 2:
+        raise IrregularMarkup('heading without text')
+    if z[0][0:5] != '<span':
+        z[0] = '<span id="'+toHtmlId(z[0])+'">'+z[0]+'</span>'
+    return headers[0]+''.join(contents)+"\n\n"+'## '+z[0]+"\n"+z[1]
+
+def renderBody(body):
+    # wikifyBodyStages() walking the body once for references and wiki links, the
+    # code blocks and markdown links are taken out before, headers and hive links
+    # done on the result. Raises IrregularMarkup for markup those stages treat in
+    # ways this doesn't reproduce (unclosed or nested references and links, runs
+    # of four backticks, ...), wikifyBody() uses wikifyBodyStages() for those.
+    if '````' in body:
+        raise IrregularMarkup('backticks')
+    parts = body.split("```")
+    codeblocks = [val.replace('<ref>|Reference: ','<ref>') for val in parts[1::2]]
+    texts = parts[0::2]
+    if len(parts) % 2 == 0:
+        texts.append('')
+    text = restoreLinks('``````'.join(texts))
+    placeholders = text.count('``````')
+    if placeholders > len(codeblocks):
+        raise IrregularMarkup('code block in a link')
+    codeblocks = codeblocks[:placeholders]
+
+    # references, in order of their first citation, and the text around them
+    references = {}
+    numbers = {}
+    new_body = []
+    links = []
+    linked = False
+    pos = 0
+    cited = False
+    start = None
+    for token in referenceTokens.finditer(text):
+        tag = token.group(0)
+        if start is not None:
+            if tag != '</ref>':
+                raise IrregularMarkup('unclosed reference')
+            val = text[start:token.start()]
+            if val not in references:
+                numbers[val] = len(references)+1
+            references[val] = references.get(val, 0)+1
+            num = str(numbers[val])
+            new_body.append('<sup><a href="#reference_'+num+'" id="cite_ref'+num+'_'+str(references[val])+'">['+num+"]</a></sup>")
+            start = None
+            pos = token.end()
+        elif tag == '</ref>':
+            if cited:
+                raise IrregularMarkup('unopened reference')
+        else:
+            linked = tokenizeLinks(text[pos:token.start()], new_body, links, linked)
+            start = token.end()
+            cited = True
+    if start is not None:
+        raise IrregularMarkup('unclosed reference')
+    linked = tokenizeLinks(text[pos:], new_body, links, linked)
+
+    if len(references) > 0:
+        new_body.append("\n## References\n")
+        for i, (val, times) in enumerate(references.items(), 1):
+            new_body.append(str(i)+'. ')
+            for j in range(1, times+1):
+                new_body.append('<a class="toref" href="#cite_ref'+str(i)+'_'+str(j)+'">↑</a> ')
+            new_body.append('<span id="reference_'+str(i)+'">')
+            linked = tokenizeLinks(val, new_body, links, linked)
+            new_body.append("</span>\n")
+
+    # the html of every link, in order of appearance for the related articles
+    spans = {}
+    for i in links:
+        spans.setdefault(new_body[i], None)
+    existing = getExistingPermlinks([unformatWikiLink(link.split('|')[0]) for link in spans])
+    related = []
+    seen = set()
+    for link in spans:
+        linkNoFragment = link.split('|')[0]
+        exists = existing[unformatWikiLink(linkNoFragment)]
+        spans[link] = '<span title="%s" %s>[[%s]]</span>' % (link, ' class="article404"' if exists < 1 else '', link)
+        rel = ('[[%s]]' % formatWikiLink(linkNoFragment), exists, linkNoFragment.lower())
+        if ':' not in link and rel not in seen:
+            seen.add(rel)
+            related.append(rel)
+    for i in links:
+        new_body[i] = spans[new_body[i]]
+    if len(related) > 0:
+        new_body.append("\n## Related Articles\n")
+        for (rel,exists,title) in related:
+            new_body.append('<span title="%s"%s>%s</span>\n' % (title, ' class="article404"' if exists < 1 else '', rel))
+
+    new_body = renderHeaders(''.join(new_body))
+    new_body = wikifyHiveLinks(new_body)
+
+    parts = new_body.split("```")
+    if len(parts)//2 > len(codeblocks):
+        raise IrregularMarkup('code block in a heading')
+    for i in range(1, len(parts), 2):
+        parts[i] = "```"+codeblocks[i//2]+"```"
+    return ''.join(parts)
     
+def getExistingPermlinks(permlinks):
+    # memo for the current request, permlink -> 1 if the article exists, else 0
+    if 'existing_permlinks' not in g:
+        g.existing_permlinks = {}
+    existing = g.existing_permlinks
+    missing = list(set(permlinks) - existing.keys())
+    if missing:
+        found = db_get_all('SELECT permlink FROM posts WHERE permlink = ANY(%s)',(missing,))
+        for permlink in missing:
+            existing[permlink] = 0
+        for permlink in found:
+            existing[permlink[0]] = 1
+    return existing
+
 def toHtmlId(string):
     return string.replace(' ','').replace(',','').replace(':','').replace('.','')
 
+def getPost(permlink):
+    # current version of an article as stored by the updater, the chain is only asked if it isn't stored (yet)
+    data = db_get_all('SELECT title, body, json_metadata FROM posts WHERE permlink=%s AND body IS NOT NULL',(permlink,))
+    if len(data) > 0:
+        return {'title': data[0][0], 'body': data[0][1], 'json_metadata': json.loads(data[0][2])}
+    if not current_app.config['CHAIN_FALLBACK']:
+        raise LookupError('Article %s is not stored' % permlink)
+    post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
+    return {'title': post['title'], 'body': post['body'], 'json_metadata': post['json_metadata']}
+
+def getRevision(cur,trx_id):
+    # operation of a single edit, body is the full text or a patch to the previous revision.
+    # Uses the cursor of the caller, a request never holds more than one pooled connection.
+    cur.execute('SELECT title, body, json_metadata FROM comments WHERE trx_id=%s AND body IS NOT NULL',(trx_id,))
+    data = cur.fetchall()
+    if len(data) > 0:
+        return {'title': data[0][0], 'body': data[0][1], 'json_metadata': json.loads(data[0][2])}
+    if not current_app.config['CHAIN_FALLBACK']:
+        raise LookupError('Revision %s is not stored' % trx_id)
+    rev = current_app.extensions['transaction_cache'].get(cur,trx_id,lambda trx_id: Blockchain().get_transaction(trx_id))['operations'][0]['value']
+    rev['json_metadata'] = json.loads(rev['json_metadata'])
+    return rev
+
 def getRevisionBody(permlink,trx_id):
-    dmp = diff_match_patch()
-    last_edit = db_get_all('SELECT trx_id FROM comments WHERE permlink=%s ORDER BY timestamp DESC LIMIT 1;',(permlink,))[0]
-    hive = Blockchain()
-    patch = []
+    last_edit = db_get_all('SELECT trx_id FROM posts WHERE permlink=%s;',(permlink,))[0]
     if(last_edit[0] == trx_id):
-        body = Comment(current_app.config['WIKI_USER']+'/'+permlink).body
+        body = getPost(permlink)['body']
     else:
         timestamp = db_get_all('SELECT timestamp FROM comments WHERE trx_id=%s ORDER BY timestamp DESC LIMIT 1;',(trx_id,))[0][0]
-        edits_before = db_get_all('SELECT trx_id FROM comments WHERE permlink=%s and timestamp <= %s ORDER BY timestamp ASC',(permlink,timestamp,))
-        body = ''
-        for edit in edits_before:
-            rev = hive.get_transaction(edit[0])['operations'][0]['value']
-            try:
-                patch += (dmp.patch_fromText(rev['body']))
-            except: 
-                body = rev['body']
-    if(len(patch) > 0):
-        body = dmp.patch_apply(patch,body)[0]
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            body = materializeRevision(cur,permlink,timestamp,current_app.config['REVISION_SNAPSHOT_INTERVAL'],lambda trx_id: getRevision(cur,trx_id)['body'])
+            cur.close()
     return restoreSource(body)
 
 def replaceLinebreaks(body):
     return body.replace("\n",'<br>')
 
+def compareSource(body):
+    return restoreSource(body).replace('<ref>','[* ').replace('</ref>',']')
+
+def renderDiff(diffs,insert_tag,delete_tag):
+    # html of a diff, all text is escaped
+    html = []
+    for (op, text) in diffs:
+        text = replaceLinebreaks(str(escape(text)))
+        if op == 1:
+            html.append('<%s>%s</%s>' % (insert_tag,text,insert_tag))
+        elif op == -1:
+            html.append('<%s>%s</%s>' % (delete_tag,text,delete_tag))
+        else:
+            html.append(text)
+    return ''.join(html)
+
 @bp.context_processor
 def inject_session_data():
     return dict(session=session)
 
 @bp.before_request
 def before_request():
-    if 'username' not in session.keys():
+    if 'username' not in session.keys() and 'userlevel' in session.keys():
         session.pop('userlevel',None)
     if 'username' in session.keys():
-        userlevel = 0
-        account = Account(current_app.config['WIKI_USER'])
-        for key in account["posting"]["account_auths"]:
-            if key[0] == session['username']:
-                userlevel = key[1]
-        session['userlevel'] = userlevel
+        session['userlevel'] = current_app.extensions['authority_cache'].get().get(session['username'],0)
 
 @bp.after_request
 def add_header(response):
-    # response.cache_control.no_store = True
+    # routes that can be cached set their own Cache-Control, nothing else is
+    # stored. Pages of logged in users are only kept by their browser.
     if 'Cache-Control' not in response.headers:
         response.headers['Cache-Control'] = 'no-store'
+    elif 'username' in session.keys() and response.cache_control.public:
+        response.cache_control.public = False
+        response.cache_control.private = True
+    if response.cache_control.public or response.cache_control.private:
+        response.vary.add('Cookie')
+    return response
+
+def pageETag(trx_id):
+    # pages of an article change with its latest edit and with the logged in
+    # user, whose userlevel decides the menu. A page showing flashed messages
+    # has no ETag, it is shown once and not stored.
+    if session.get('_flashes'):
+        return None
+    if 'username' in session.keys():
+        return trx_id+'-'+session['username']+'-'+str(session.get('userlevel',0))
+    return trx_id
+
+def etagNotModified(etag):
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    return etagResponse(Response(status=304), etag)
+
+def etagResponse(response, etag):
+    # may be stored, but has to be revalidated with its ETag
+    response = make_response(response)
+    if etag is None:
+        return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+def immutableResponse(response):
+    response = make_response(response)
+    response.headers['Cache-Control'] = 'public, max-age='+str(current_app.config['IMMUTABLE_MAX_AGE'])+', immutable'
     return response
 
 @bp.route('/wiki')
@@ -418,10 +694,10 @@ def edit(article):
     permlink = unformatPostLink(article_f)
         
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
-        body = Markup(xssEscape(restoreSource(post.body)))
-        post.json_metadata['tags'].remove('wiki')
-        return render_template('edit.html',post=post,body=body,article_title=xssEscape(post.title),pagetitle='Edit article')
+        post = getPost(permlink)
+        body = Markup(xssEscape(restoreSource(post['body'])))
+        post['json_metadata']['tags'].remove('wiki')
+        return render_template('edit.html',post=post,body=body,article_title=xssEscape(post['title']),pagetitle='Edit article')
     except:
         return redirect(url_for('wiki.create', article=article_f))
         
@@ -436,12 +712,29 @@ def wiki(article):
     permlink = unformatPostLink(article_f)
 
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
-        last_update = [db_get_all('SELECT timestamp FROM comments WHERE permlink=%s ORDER BY timestamp DESC LIMIT 1',(permlink,))[0][0]]
-        if post.json_metadata['appdata']['user']:
-            last_update.append(post.json_metadata['appdata']['user'])   
-        body = Markup(xssEscape(wikifyBody(post.body)))
-        return render_template('wiki.html',post=post,body=body,last_update=last_update,pagetitle=xssEscape(post.title))
+        latest = db_get_all('SELECT trx_id, last_modified, links_version FROM posts WHERE permlink=%s',(permlink,))[0]
+        # the updater counts up links_version when a linked article is created
+        version = latest[0]+'.'+str(latest[2])
+        etag = pageETag(version)
+        not_modified = etagNotModified(etag)
+        if not_modified is not None:
+            return not_modified
+        render_cache = current_app.extensions['render_cache']
+        cached = render_cache.get(permlink,version)
+        if cached is None:
+            post = getPost(permlink)
+            cached = {
+                'title': post['title'],
+                'tags': post['json_metadata']['tags'],
+                'user': post['json_metadata']['appdata']['user'],
+                'body': xssEscape(wikifyBody(post['body']))
+            }
+            render_cache.set(permlink,version,cached)
+        post = {'title': cached['title'], 'json_metadata': {'tags': cached['tags']}}
+        last_update = [latest[1]]
+        if cached['user']:
+            last_update.append(cached['user'])
+        return etagResponse(render_template('wiki.html',post=post,body=Markup(cached['body']),last_update=last_update,pagetitle=xssEscape(cached['title'])),etag)
     except:
         post = {
             'title': article_f,
@@ -463,27 +756,91 @@ def source(article):
         return redirect(url_for('wiki.source', article=article_f),301)   
     permlink = unformatPostLink(article_f)
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
-        return render_template('source.html',post=post,body=restoreSource(post.body),pagetitle='View source')   
+        latest = db_get_all('SELECT trx_id FROM posts WHERE permlink=%s AND trx_id IS NOT NULL',(permlink,))
+        if len(latest) > 0:
+            etag = pageETag(latest[0][0])
+            not_modified = etagNotModified(etag)
+            if not_modified is not None:
+                return not_modified
+        post = getPost(permlink)
+        response = render_template('source.html',post=post,body=restoreSource(post['body']),pagetitle='View source')
+        if len(latest) > 0:
+            return etagResponse(response,etag)
+        return response
     except:
         return redirect(url_for('wiki.create', article=article_f))
     
+def renderHeadline(headline):
+    # ts_headline marks matches with \x02 and \x03, the text around them is escaped
+    return str(escape(headline)).replace('\x02','<b>').replace('\x03','</b>')
+
 @bp.route('/search/<search>')
 def search(search):
-    results = db_get_all('SELECT permlink, ts_rank_cd(tsvector,websearch_to_tsquery(%s)) AS rank FROM posts WHERE tsvector @@ websearch_to_tsquery(%s) ORDER BY rank DESC;',(search,search,))
-    return render_template('search.html',search=search,results=results,pagetitle='Search')
+    query = ' '.join(search.lower().split())
+    try:
+        page = max(1,int(request.args.get('page','1')))
+    except ValueError:
+        page = 1
+    search_cache = current_app.extensions['search_cache']
+    cursor, cached = search_cache.get(query,page)
+    if cached is None:
+        page_size = current_app.config['SEARCH_PAGE_SIZE']
+        # ranked on the weighted tsvector of the updater, headlines only for the rows of the page
+        data = db_get_all('SELECT r.permlink, coalesce(p.title, r.permlink),'
+            ' ts_headline(coalesce(p.body,\'\'), websearch_to_tsquery(%s), %s) FROM'
+            ' (SELECT permlink, ts_rank_cd(tsvector,websearch_to_tsquery(%s)) AS rank FROM posts WHERE tsvector @@ websearch_to_tsquery(%s)'
+            ' ORDER BY rank DESC, permlink LIMIT %s OFFSET %s) r'
+            ' JOIN posts p ON p.permlink = r.permlink ORDER BY r.rank DESC, r.permlink;',
+            (query,'StartSel="\x02", StopSel="\x03", MaxFragments=2, MaxWords=30, MinWords=10',query,query,page_size+1,(page-1)*page_size))
+        cached = {
+            'results': [[formatPostLink(row[0]),row[1],renderHeadline(row[2])] for row in data[:page_size]],
+            'more': len(data) > page_size
+        }
+        if cursor is not None:
+            search_cache.set(cursor,query,page,cached)
+    results = [[result[0],result[1],Markup(result[2])] for result in cached['results']]
+    older = url_for('wiki.search', search=search, page=page+1) if cached['more'] else None
+    newer = url_for('wiki.search', search=search, page=page-1) if page > 1 else None
+    return render_template('search.html',search=search,results=results,older=older,newer=newer,pagetitle='Search')
 
 @bp.route('/activity')
 def activity():
-    data = db_get_all('SELECT trx_id, timestamp, permlink, author FROM comments ORDER BY timestamp DESC;')
-    edits = []
-    for i, edit in enumerate(data):
+    before = request.args.get('before','')
+    before_trx = request.args.get('trx','')
+    if before != '':
         try:
-            before = db_get_all('SELECT trx_id FROM comments WHERE permlink = %s AND timestamp<%s ORDER BY timestamp DESC LIMIT 1;',(edit[2],edit[1],))[0]
-            edits.append([edit[0],edit[1],formatPostLink(edit[2]),edit[3],before[0]])
-        except:
-            edits.append([edit[0],edit[1],formatPostLink(edit[2]),edit[3],''])
-    return render_template('activity.html',edits=edits,notabs=True,pagetitle='Activity')
+            before = datetime.datetime.fromisoformat(before)
+        except ValueError:
+            return redirect(url_for('wiki.activity'))
+    else:
+        before = datetime.datetime.max
+    page_size = current_app.config['ACTIVITY_PAGE_SIZE']
+    # keyset page of edits, the previous revision of each edit is looked up through the (permlink, timestamp) index
+    data = db_get_all('SELECT c.trx_id, c.timestamp, c.permlink, c.author, coalesce(p.trx_id,\'\') FROM'
+        ' (SELECT trx_id, timestamp, permlink, author FROM comments WHERE (timestamp, trx_id) < (%s, %s) ORDER BY timestamp DESC, trx_id DESC LIMIT %s) c'
+        ' LEFT JOIN LATERAL (SELECT trx_id FROM comments WHERE permlink = c.permlink AND timestamp < c.timestamp ORDER BY timestamp DESC LIMIT 1) p ON true'
+        ' ORDER BY c.timestamp DESC, c.trx_id DESC;',(before,before_trx,page_size,))
+    edits = []
+    for edit in data:
+        edits.append([edit[0],edit[1],formatPostLink(edit[2]),edit[3],edit[4]])
+    older = None
+    if len(edits) == page_size:
+        older = url_for('wiki.activity', before=edits[-1][1].isoformat(), trx=edits[-1][0])
+    newest = url_for('wiki.activity') if request.args.get('before','') != '' else None
+    return render_template('activity.html',edits=edits,older=older,newest=newest,notabs=True,pagetitle='Activity')
+
+@bp.route('/links/<article>')
+def backlinks(article):
+    article_f = formatPostLink(article)
+    if(article_f != article):
+        return redirect(url_for('wiki.backlinks', article=article_f),301)
+    permlink = unformatPostLink(article_f)
+    title = db_get_all('SELECT coalesce(title, permlink) FROM posts WHERE permlink=%s',(permlink,))
+    post = {'title': title[0][0] if len(title) > 0 else article_f.replace('-',' ')}
+    links = db_get_all('SELECT l.source, coalesce(p.title, l.source) FROM links l JOIN posts p ON p.permlink = l.source'
+        ' WHERE l.target=%s ORDER BY 2',(permlink,))
+    links = [(formatPostLink(source), title) for source, title in links]
+    return render_template('links.html',post=post,links=links,pagetitle='What links here')
 
 @bp.route('/history/<article>')
 def history(article):
@@ -492,7 +849,7 @@ def history(article):
         return redirect(url_for('wiki.history', article=article_f),301)   
     permlink = unformatPostLink(article_f)
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
+        post = {'title': db_get_all('SELECT coalesce(title, permlink) FROM posts WHERE permlink=%s',(permlink,))[0][0]}
     except:
         return redirect(url_for('wiki.create', article=article_f))
         
@@ -501,7 +858,8 @@ def history(article):
 
 @bp.route('/revision/<trx_id>')
 def revision_raw(trx_id):
-    return redirect(url_for('wiki.revision', article=formatPostLink(db_get_all('SELECT permlink FROM comments WHERE trx_id=%s LIMIT 1;',(trx_id,))[0][0]), trx_id=trx_id),301)
+    # the article of an edit never changes
+    return immutableResponse(redirect(url_for('wiki.revision', article=formatPostLink(db_get_all('SELECT permlink FROM comments WHERE trx_id=%s LIMIT 1;',(trx_id,))[0][0]), trx_id=trx_id),301))
 
 @bp.route('/history/<article>/revision/<trx_id>')
 def revision(article, trx_id):
@@ -510,16 +868,25 @@ def revision(article, trx_id):
         return redirect(url_for('wiki.revision', article=article_f, trx_id=trx_id),301)
     
     permlink = unformatPostLink(article_f)
-    hive = Blockchain()
-    post = hive.get_transaction(trx_id)
-    post = post['operations'][0]['value']
-    post['json_metadata'] = json.loads(post['json_metadata'])
+    # the notice links the latest and the next edit and the body has red links,
+    # the page changes with them like the article
+    latest = db_get_all('SELECT trx_id, links_version FROM posts WHERE permlink=%s AND trx_id IS NOT NULL',(permlink,))
+    etag = None
+    if len(latest) > 0:
+        etag = pageETag(latest[0][0]+'.'+str(latest[0][1]))
+        not_modified = etagNotModified(etag)
+        if not_modified is not None:
+            return not_modified
+    with get_db_connection() as conn:
+        cur = conn.cursor()
+        post = getRevision(cur,trx_id)
+        cur.close()
 
     body = Markup(xssEscape(wikifyBody(getRevisionBody(permlink,trx_id))))
     last_update = [db_get_all('SELECT timestamp FROM comments WHERE trx_id=%s LIMIT 1;',(trx_id,))[0][0],post['json_metadata']['appdata']['user']]
-    latest = db_get_all('SELECT trx_id, timestamp, author FROM comments WHERE permlink=%s ORDER BY timestamp DESC LIMIT 1',(permlink,))[0]
-    latest_update = [latest[1],latest[2]]
-    latest_revision = latest[0]
+    newest = db_get_all('SELECT trx_id, timestamp, author FROM comments WHERE permlink=%s ORDER BY timestamp DESC LIMIT 1',(permlink,))[0]
+    latest_update = [newest[1],newest[2]]
+    latest_revision = newest[0]
     if(latest_revision == trx_id):
         return redirect(url_for('wiki.wiki', article=article))
     try:
@@ -527,7 +894,7 @@ def revision(article, trx_id):
     except:
         older_revision = ''
     newer_revision = db_get_all('SELECT trx_id FROM comments WHERE permlink=%s AND timestamp > %s ORDER BY timestamp ASC LIMIT 1',(permlink,last_update[0]))[0][0]
-    return render_template('wiki.html',pagetitle='Revision',post=post,body=body,last_update=last_update,revision=trx_id,permlink=article_f,latest_update=latest_update,latest_revision=latest_revision,older_revision=older_revision,newer_revision=newer_revision)
+    return etagResponse(render_template('wiki.html',pagetitle='Revision',post=post,body=body,last_update=last_update,revision=trx_id,permlink=article_f,latest_update=latest_update,latest_revision=latest_revision,older_revision=older_revision,newer_revision=newer_revision),etag)
 
 @bp.route('/history/<article>/compare/<revision_1>/<revision_2>')
 def compare(article, revision_1, revision_2):
@@ -535,17 +902,56 @@ def compare(article, revision_1, revision_2):
     if(article_f != article):
         return redirect(url_for('wiki.compare', article=article_f, revision_1=revision_1, revision_2=revision_2),301)  
     permlink = unformatPostLink(article)
-    body_1 = Markup(xssEscape(replaceLinebreaks(getRevisionBody(permlink,revision_1).replace("'","|0x27|").replace('<ref>','[* ').replace('</ref>',']').replace('\\','\\\\'))))
-    body_2 = Markup(xssEscape(replaceLinebreaks(getRevisionBody(permlink,revision_2).replace("'","|0x27|").replace('<ref>','[* ').replace('</ref>',']').replace('\\','\\\\'))))
-
-    data_1 = db_get_all('SELECT timestamp, author, trx_id FROM comments WHERE trx_id=%s LIMIT 1',(revision_1,))[0]
-    data_2 = db_get_all('SELECT timestamp, author, trx_id FROM comments WHERE trx_id=%s LIMIT 1',(revision_2,))[0]
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
+        latest = db_get_all('SELECT coalesce(title, permlink), trx_id FROM posts WHERE permlink=%s',(permlink,))[0]
     except:
         return redirect(url_for('wiki.create', article=article_f))
-    return render_template('compare.html',pagetitle='Compare revisions',post=post,permlink=formatPostLink(permlink),body_1=body_1,body_2=body_2,data_1=data_1,data_2=data_2)
+    # the diff never changes, the title of the article changes with its latest edit
+    if latest[1] is not None:
+        etag = pageETag(latest[1])
+        not_modified = etagNotModified(etag)
+        if not_modified is not None:
+            return not_modified
+    post = {'title': latest[0]}
+    data_1 = db_get_all('SELECT timestamp, author, trx_id FROM comments WHERE trx_id=%s AND permlink=%s LIMIT 1',(revision_1,permlink,))[0]
+    data_2 = db_get_all('SELECT timestamp, author, trx_id FROM comments WHERE trx_id=%s AND permlink=%s LIMIT 1',(revision_2,permlink,))[0]
+
+    diff_cache = current_app.extensions['diff_cache']
+    cached = diff_cache.get(revision_1,revision_2)
+    if cached is None:
+        with get_db_connection() as conn:
+            cur = conn.cursor()
+            body_1, body_2 = materializeRevisions(cur,permlink,[data_1[0],data_2[0]],current_app.config['REVISION_SNAPSHOT_INTERVAL'],lambda trx_id: getRevision(cur,trx_id)['body'])
+            cur.close()
+        diffs = diffRevisions(compareSource(body_1),compareSource(body_2))
+        cached = {
+            'diff': renderDiff(diffs,'ins','del'),
+            'diff_reverse': renderDiff(diffs,'del','ins')
+        }
+        diff_cache.set(revision_1,revision_2,cached)
+    response = render_template('compare.html',pagetitle='Compare revisions',post=post,permlink=formatPostLink(permlink),diff=Markup(cached['diff']),diff_reverse=Markup(cached['diff_reverse']),data_1=data_1,data_2=data_2)
+    if latest[1] is not None:
+        return etagResponse(response,etag)
+    return response
     
+def talkFetcher(permlink):
+    # the replies to an article from a Hive node, sanitized. Also called
+    # outside of the request by the talk cache.
+    wiki_user = current_app.config['WIKI_USER']
+    def fetch():
+        replies = []
+        for reply in Comment(wiki_user+'/'+permlink).get_all_replies():
+            replies.append({
+                'author': reply['author'],
+                'permlink': reply['permlink'],
+                'created': str(reply['created']),
+                'title': reply['title'],
+                'short': xssEscape(reply.body[0:55]+'...'),
+                'body': xssEscape(reply.body)
+            })
+        return replies
+    return fetch
+
 @bp.route('/talk/<article>')
 def talk(article):
     article_f = formatPostLink(article)
@@ -554,51 +960,51 @@ def talk(article):
     permlink = unformatPostLink(article)
 
     try:
-        post = Comment(current_app.config['WIKI_USER']+"/"+permlink)
-        data = Comment(current_app.config['WIKI_USER']+'/'+permlink).get_all_replies()
-        replies = []
-        for d in data:
-            replies.append({
-                'body': Markup(xssEscape(d.body)),
-                'short': Markup(xssEscape(d.body[0:55]+'...'))
-            })
-        return render_template('talk.html',permlink=permlink,post=post,data=data,replies=replies,pagetitle='Talk')
+        post = getPost(permlink)
+        replies = current_app.extensions['talk_cache'].get(permlink,talkFetcher(permlink))
+        replies = [dict(reply, short=Markup(reply['short'])) for reply in replies]
+        return render_template('talk.html',permlink=permlink,article=article_f,post=post,replies=replies,pagetitle='Talk')
     except:
         return redirect(url_for('wiki.create', article=article_f))
 
+@bp.route('/api/talk/<article>/<author>/<reply>')
+def talk_reply(article, author, reply):
+    # body of a reply, talk pages load them when a reply is opened
+    permlink = unformatPostLink(formatPostLink(article))
+    body = current_app.extensions['talk_cache'].body(permlink,author,reply,talkFetcher(permlink))
+    if body is None:
+        abort(404)
+    return jsonify({'body': body})
+
 
 @bp.route('/wiki/Categories:Overview')
 def categories():
-    categories = db_get_all('SELECT category FROM categories ORDER BY category;')
-    c = []
-    for category in categories:
-        count = db_count('SELECT count(category) FROM categories_posts WHERE category=%s;',(category[0],))
-        if count > 0:
-            c.append((category[0],count))
-    return render_template('categories.html', categories=c,notabs=True,pagetitle='Categories')
+    # post_count is maintained by the updater, empty categories are removed there
+    categories = db_get_all('SELECT category, post_count FROM categories ORDER BY category;')
+    return render_template('categories.html', categories=categories,notabs=True,pagetitle='Categories')
 
 @bp.route('/wiki/Category:<category>')
 def category(category):
-    data = db_get_all('SELECT permlink FROM categories_posts WHERE category=%s;',(category.lower(),))
+    data = db_get_all('SELECT p.permlink, coalesce(p.title, p.permlink) AS title FROM categories_posts cp JOIN posts p ON p.permlink = cp.permlink'
+        ' WHERE cp.category=%s ORDER BY lower(coalesce(p.title, p.permlink));',(category.lower(),))
     posts = []
-    for i, post in enumerate(data):
+    for post in data:
         posts.append({
             'article': formatPostLink(post[0]),
-            'title': Comment(current_app.config['WIKI_USER']+"/"+post[0]).title
+            'title': post[1]
         })
     return render_template('category.html', category=category,posts=posts,notabs=True,pagetitle=category.capitalize())
 
 @bp.route('/random')
 def random_article():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT permlink FROM posts;')
-    permlinks = cur.fetchall()
-    cur.close()
-    conn.close()
-    import random
-    rand = random.randint(0, len(permlinks)-1)
-    return redirect(url_for('wiki.wiki', article=formatPostLink(permlinks[rand][0])))
+    # ?category=<category> picks from a category, ?disambiguation=0 skips disambiguation pages
+    category = request.args.get('category')
+    permlink = current_app.extensions['title_index'].random(
+        category.lower() if category else None,
+        disambiguation=request.args.get('disambiguation','1') != '0')
+    if permlink is None:
+        return redirect(url_for('wiki.wiki', article=formatPostLink(current_app.config['START_PAGE'])))
+    return redirect(url_for('wiki.wiki', article=formatPostLink(permlink)))
 
 @bp.route('/contributions')
 def contributions():
@@ -718,19 +1124,100 @@ def robots_txt():
     text += "Sitemap: "+request.url_root+"sitemap.xml"
     return Response(text, mimetype='text/text')
 
+def sitemapState():
+    # number of articles and time of the newest edit
+    return db_get_all('SELECT count(*), max(last_modified) FROM posts')[0]
+
+def notModifiedSince(last_modified):
+    since = request.if_modified_since
+    if since is None or last_modified is None:
+        return False
+    return last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+
+def sitemapResponse(xml, last_modified):
+    if notModifiedSince(last_modified):
+        response = Response(status=304)
+    else:
+        response = Response(xml, mimetype='text/xml')
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def sitemapUrlset(url_root, wiki_pages):
+    yield '<?xml version="1.0" encoding="UTF-8"?>'+"\n"
+    yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'+"\n"
+    for page in wiki_pages:
+        yield ("    <url>\n"
+            "        <loc>"+url_root+"wiki/"+formatPostLink(page[0])+"</loc>"
+            "        <lastmod>"+page[1].strftime("%Y-%m-%d")+"</lastmod>"
+            "    </url>")
+    yield "</urlset>"
+
+def sitemapIndex(url_root, sitemaps):
+    yield '<?xml version="1.0" encoding="UTF-8"?>'+"\n"
+    yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'+"\n"
+    for sitemap in sitemaps:
+        yield ("    <sitemap>\n"
+            "        <loc>"+url_root+"sitemap-"+str(sitemap[0]+1)+".xml</loc>"
+            "        <lastmod>"+sitemap[1].strftime("%Y-%m-%d")+"</lastmod>"
+            "    </sitemap>")
+    yield "</sitemapindex>"
+
 @bp.route('/sitemap.xml')
 def sitemap_xml():
-    wiki_pages = db_get_all('SELECT permlink FROM posts')
-    xml = '<?xml version="1.0" encoding="UTF-8"?>'+"\n"
-    xml += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'+"\n"
-    for page in wiki_pages:
-        last_edit = db_get_all('SELECT timestamp FROM comments WHERE permlink=%s ORDER BY timestamp DESC LIMIT 1',(page[0],))[0][0]
-        xml += "    <url>\n"
-        xml += "        <loc>"+request.url_root+"wiki/"+formatPostLink(page[0])+"</loc>"
-        xml += "        <lastmod>"+last_edit.strftime("%Y-%m-%d")+"</lastmod>"
-        xml += "    </url>"
-    xml += "</urlset>"
-    return Response(xml, mimetype='text/xml')
+    # all articles, or an index of sitemaps with SITEMAP_SIZE articles each
+    # once there are more
+    count, last_modified = sitemapState()
+    if notModifiedSince(last_modified):
+        return sitemapResponse(None, last_modified)
+    size = current_app.config['SITEMAP_SIZE']
+    if count <= size:
+        wiki_pages = db_get_all('SELECT permlink, last_modified FROM posts ORDER BY permlink')
+        return sitemapResponse(sitemapUrlset(request.url_root, wiki_pages), last_modified)
+    sitemaps = db_get_all('SELECT page, max(last_modified) FROM'
+        ' (SELECT (row_number() OVER (ORDER BY permlink) - 1) / %s AS page, last_modified FROM posts) numbered'
+        ' GROUP BY page ORDER BY page', (size,))
+    return sitemapResponse(sitemapIndex(request.url_root, sitemaps), last_modified)
+
+@bp.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    count, last_modified = sitemapState()
+    size = current_app.config['SITEMAP_SIZE']
+    if page < 1 or (page-1)*size >= count:
+        abort(404)
+    if notModifiedSince(last_modified):
+        return sitemapResponse(None, last_modified)
+    wiki_pages = db_get_all('SELECT permlink, last_modified FROM posts ORDER BY permlink LIMIT %s OFFSET %s', (size, (page-1)*size))
+    return sitemapResponse(sitemapUrlset(request.url_root, wiki_pages), last_modified)
+
+@bp.route('/api/status')
+def api_status():
+    return jsonify({
+        'db_pool': current_app.extensions['db_pool'].stats(),
+        'render_cache': current_app.extensions['render_cache'].size(),
+        'title_index': current_app.extensions['title_index'].size()
+    })
+
+def similarTitles(search, limit):
+    # typo tolerant matches, needs the pg_trgm extension set up by the updater
+    try:
+        return db_get_all('SELECT permlink, coalesce(title, permlink) FROM posts WHERE title %% %s ORDER BY similarity(title, %s) DESC LIMIT %s',(search,search,limit))
+    except psycopg2.Error:
+        return []
+
+@bp.route('/api/suggest')
+def api_suggest():
+    search = request.args.get('q','').strip()
+    try:
+        limit = min(max(1,int(request.args.get('limit','10'))),50)
+    except ValueError:
+        limit = 10
+    suggestions = []
+    if search != '':
+        suggestions = current_app.extensions['title_index'].search(search,limit)
+        if len(suggestions) == 0 and current_app.config['SUGGEST_FUZZY']:
+            suggestions = similarTitles(search,limit)
+    return jsonify([{'article': formatPostLink(permlink), 'title': title} for permlink, title in suggestions])
 
 if __name__ == '__main__':
     bp.run(debug=True)
\ No newline at end of file